@@ -0,0 +1,52 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# InsteonAddress construction, hashing and device table lookups.
+
+from __future__ import absolute_import
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+SETUP = '''
+from txHA.insteon import InsteonAddress
+binary = '\\x22\\xb7\\x00'
+address = InsteonAddress(binary)
+devices = dict((InsteonAddress(1, 2, i), i) for i in range(256))
+devices[address] = None
+from_bytes = getattr(InsteonAddress, 'from_bytes', InsteonAddress)
+'''
+
+TESTS = [('from string', "InsteonAddress('22.b7.00')"),
+         ('from integers', 'InsteonAddress(0x22, 0xb7, 0x00)'),
+         ('from bytes', 'InsteonAddress(binary)'),
+         ('from_bytes', 'from_bytes(binary)'),
+         ('hash', 'hash(address)'),
+         ('device lookup', 'devices[address]'),
+         ('decode and lookup', 'devices[from_bytes(binary)]')]
+
+def main(number = 200000):
+    for name, statement in TESTS:
+        elapsed = min(timeit.repeat(statement, SETUP, repeat = 3, number = number))
+        print '{:20s} {:10.0f} ops/sec'.format(name, number / elapsed)
+
+if __name__ == '__main__':
+    main()
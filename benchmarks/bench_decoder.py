@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare received frames/sec between the parsley grammar and the
+# table driven decoder.
+
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import parsley
+from ometa.tube import TrampolinedParser
+
+from txHA.insteon import _InsteonProtocolFactory
+from txHA.insteon.decoder import InsteonFrameDecoder
+
+# a mix of broadcasts, direct ACKs, echoes and ALL-Link records as
+# seen on a busy network
+FRAMES = ['\x02\x50\x22\xb7\x00\x01\x02\x03\xcb\x11\x00',
+          '\x02\x50\x22\xb7\x00\x1e\xba\xfa\x2b\x00\xff',
+          '\x02\x51\x22\xb7\x00\x1e\xba\xfa\x1b\x03\x00' + '\x00\x01\x02\x03\x01\x20\x41' + '\x00' * 7,
+          '\x02\x62\x22\xb7\x00\x0f\x19\x00\x06',
+          '\x02\x62\x22\xb7\x00\x1f\x2e\x00' + '\x00' * 14 + '\x06',
+          '\x02\x57\xe2\x01\x22\xb7\x00\x01\x20\x41',
+          '\x02\x69\x06']
+
+class Receiver(object):
+    currentRule = 'receive'
+
+    def __init__(self):
+        self.count = 0
+
+    def receive(self, *args):
+        self.count += 1
+
+    def receiveMessage(self, *args):
+        self.count += 1
+
+    def receiveMessageEcho(self, *args):
+        self.count += 1
+
+    def receiveAllLinkRecord(self, *args):
+        self.count += 1
+
+    def receiveAllLinkRecordEcho(self, *args):
+        self.count += 1
+
+def run(name, feed, receiver, chunks, frames):
+    start = time.time()
+    for chunk in chunks:
+        feed(chunk)
+    elapsed = time.time() - start
+    assert receiver.count == frames, (receiver.count, frames)
+    print '{:8s} {:10.0f} frames/sec'.format(name, frames / elapsed)
+
+def main(grammar_repeat = 100, decoder_repeat = 20000):
+    # the transport hands over roughly one frame per read
+    receiver = Receiver()
+    grammar = parsley.OMeta(_InsteonProtocolFactory.insteon_grammar).parseGrammar('Grammar')
+    parser = TrampolinedParser(grammar, receiver, _InsteonProtocolFactory.bindings)
+    run('grammar', parser.receive, receiver, FRAMES * grammar_repeat, len(FRAMES) * grammar_repeat)
+
+    receiver = Receiver()
+    decoder = InsteonFrameDecoder(receiver, _InsteonProtocolFactory.bindings)
+    run('decoder', decoder.feed, receiver, FRAMES * decoder_repeat, len(FRAMES) * decoder_repeat)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Log calls per second through txHA.log with a transport that throws
+# everything away, and debug calls per second when running at NOTICE.
+
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from twisted.internet import task
+
+from txHA import log
+
+class NullTransport(object):
+    def __init__(self):
+        self.count = 0
+
+    def send(self, event, text):
+        self.count += 1
+
+def eager(i):
+    log.debug('hops_left: {}'.format(i))
+
+def lazy(i):
+    log.debug('hops_left: {}', i)
+
+def run(name, count, call = eager):
+    start = time.time()
+    for i in xrange(count):
+        call(i)
+    elapsed = time.time() - start
+    # stdout is redirected into the log once the logger is set up
+    log.stdout_write('{:20s} {:10.0f} calls/sec\n'.format(name, count / elapsed))
+
+def main(count = 20000):
+    transport = NullTransport()
+    log.logger = log.Logger(task.Clock(), log.DEBUG, 'bench', [transport])
+
+    run('introspection', count)
+    if hasattr(log, 'setIntrospection'):
+        log.setIntrospection(False)
+        run('no introspection', count)
+        log.setIntrospection(True)
+
+    assert transport.count >= count
+
+    if hasattr(log, 'setPriority'):
+        run('lazy', count, lazy)
+        emitted = transport.count
+        log.setPriority(log.NOTICE)
+        run('suppressed eager', count * 10, eager)
+        run('suppressed lazy', count * 10, lazy)
+        assert transport.count == emitted
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Replay a capture into a complete PLM protocol as fast as possible.
+# Pass the path of a capture taken with capture=... to replay real
+# traffic, otherwise a capture of a busy network is made up.
+
+from __future__ import absolute_import
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+
+from txHA import log
+from txHA.insteon import InsteonBasePLM
+from txHA.insteon.capture import CaptureReader
+from txHA.insteon.capture import CaptureWriter
+from txHA.insteon.capture import Replayer
+from txHA.insteon.capture import INBOUND
+
+# broadcasts and ALL-Link cleanups from devices nobody asked about,
+# one frame per read
+FRAMES = ['\x02\x50\x22\xb7\x00\x01\x02\x03\xcb\x11\x00',
+          '\x02\x50\x22\xb7\x00\x00\x00\x01\xcb\x13\x00',
+          '\x02\x50\x1e\xba\xfa\x00\x00\x01\xcb\x11\x00',
+          '\x02\x50\x22\xb7\x00\x1e\xba\xfa\x41\x11\x01']
+
+class Reactor(task.Clock):
+    def callWhenRunning(self, f, *args, **kw):
+        f(*args, **kw)
+
+def make(path, repeat):
+    clock = task.Clock()
+    writer = CaptureWriter(path, clock.seconds)
+    for i in xrange(repeat):
+        for frame in FRAMES:
+            clock.advance(0.01)
+            writer.record(INBOUND, frame)
+    writer.close()
+
+def main(path = None, repeat = 20000):
+    # only measure the receive path, not the debug logging
+    log.setPriority(log.WARNING)
+
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix = '.cap')
+        os.close(fd)
+        os.unlink(path)
+        make(path, repeat)
+
+    clock = Reactor()
+    plm = InsteonBasePLM(clock)
+    protocol = plm.factory.buildProtocol(None)
+    protocol.makeConnection(proto_helpers.StringTransport())
+
+    reader = CaptureReader(path)
+    replayer = Replayer(clock, reader, protocol, speed = None)
+
+    start = time.time()
+    replayer.start()
+    elapsed = time.time() - start
+    reader.close()
+
+    print '{:8d} reads {:10.0f} reads/sec {:10.1f} MB/sec'.format(replayer.count,
+                                                                  replayer.count / elapsed,
+                                                                  replayer.size / elapsed / 1e6)
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
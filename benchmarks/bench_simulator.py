@@ -0,0 +1,83 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Ask every device of a simulated network for its status over a real
+# TCP connection and report throughput and latency of the send queue
+# and decoder together.
+
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+from txHA import log
+from txHA.insteon import InsteonNetworkPLM
+from txHA.insteon.simulator import SimulatedNetwork
+from txHA.insteon.simulator import SimulatedPLMFactory
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+@defer.inlineCallbacks
+def run(plm, network, rate):
+    plm.tbq.setRate(rate)
+    plm.tbq.bucket_size = rate
+
+    latencies = []
+    failures = [0]
+
+    def done(result, queued):
+        latencies.append(time.time() - queued)
+
+    def failed(reason):
+        failures[0] += 1
+
+    start = time.time()
+    ds = []
+    for device in network.order:
+        d = plm.sendStatusRequest(device.address, timeout = 5.0)
+        d.addCallbacks(done, failed, callbackArgs = (time.time(),))
+        ds.append(d)
+    yield defer.DeferredList(ds)
+    elapsed = time.time() - start
+
+    latencies.sort()
+    print '{:6d} devices {:8.0f} requests/sec  latency p50 {:6.3f}s p99 {:6.3f}s  failed {}'.format(
+        len(network.order), len(latencies) / elapsed,
+        percentile(latencies, 0.5), percentile(latencies, 0.99), failures[0])
+
+def main(devices = 2000, rate = 1000.0):
+    log.setPriority(log.WARNING)
+
+    network = SimulatedNetwork(reactor, devices = int(devices), ack_latency = 0.01, seed = 1)
+    port = reactor.listenTCP(0, SimulatedPLMFactory(network), interface = '127.0.0.1')
+    plm = InsteonNetworkPLM(reactor, '127.0.0.1', port.getHost().port)
+
+    d = plm.ready.addCallback(run, network, float(rate))
+    d.addErrback(log.err)
+    d.addBoth(lambda result: reactor.stop())
+    reactor.run()
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Put and get 100k items through a TokenBucketQueue, with and without
+# a backlog, and cancel 100k waiting gets.
+
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from twisted.internet import task
+
+from txHA.tbq import TokenBucketQueue
+
+def report(name, count, elapsed):
+    print '{:20s} {:10.0f} items/sec'.format(name, count / elapsed)
+
+def backlog(count):
+    # everything is queued before anybody asks for it, then drained
+    # as fast as the clock allows
+    clock = task.Clock()
+    tbq = TokenBucketQueue(clock, 1000.0, 1.0)
+    received = []
+
+    start = time.time()
+    for i in xrange(count):
+        tbq.put(i)
+    for i in xrange(count):
+        tbq.get().addCallback(received.append)
+    while len(received) < count:
+        clock.advance(0.001)
+    report('put then get', count, time.time() - start)
+
+def waiters(count):
+    # getters are queued first and each put hands over immediately
+    clock = task.Clock()
+    tbq = TokenBucketQueue(clock, 1000.0, count)
+    received = []
+
+    start = time.time()
+    for i in xrange(count):
+        tbq.get().addCallback(received.append)
+    for i in xrange(count):
+        tbq.put(i)
+    assert len(received) == count
+    report('get then put', count, time.time() - start)
+
+def cancel(count):
+    clock = task.Clock()
+    tbq = TokenBucketQueue(clock, 1000.0, 1.0)
+    ds = [tbq.get() for i in xrange(count)]
+
+    start = time.time()
+    for d in ds:
+        d.addErrback(lambda f: None)
+        d.cancel()
+    tbq.put(None)
+    report('cancel', count, time.time() - start)
+
+def main(count = 100000):
+    backlog(count)
+    waiters(count)
+    cancel(count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Log through JournalTransport into a local UNIX datagram socket
+# standing in for journald and check that every datagram holds exactly
+# one well formed entry, including binary safe fields.
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from twisted.internet import protocol
+from twisted.internet import reactor
+
+from txHA import log
+
+MESSAGES = [u'plain', u'multi\nline', u'caf\xe9', u'=equals=']
+
+class Journal(protocol.DatagramProtocol):
+    def __init__(self):
+        self.datagrams = []
+
+    def datagramReceived(self, data, address):
+        self.datagrams.append(data)
+
+def parse(data):
+    """Parse one entry of journald's native protocol into a dict."""
+
+    fields = {}
+    offset = 0
+    while offset < len(data):
+        newline = data.index('\n', offset)
+        line = data[offset:newline]
+        if '=' in line:
+            name, value = line.split('=', 1)
+            offset = newline + 1
+        else:
+            name = line
+            length, = struct.unpack_from('<Q', data, newline + 1)
+            start = newline + 1 + 8
+            value = data[start:start + length]
+            assert data[start + length] == '\n', 'binary field {} not terminated'.format(name)
+            offset = start + length + 1
+        assert name not in fields, 'field {} repeated, more than one entry in a datagram'.format(name)
+        fields[name] = value
+    return fields
+
+def check(journal, transport, errors):
+    transport.flush()
+    reactor.callLater(0.2, verify, journal, transport, errors)
+
+def verify(journal, transport, errors):
+    try:
+        assert transport.dropped == 0, transport.dropped
+        assert len(journal.datagrams) == len(MESSAGES), len(journal.datagrams)
+        for index, (data, text) in enumerate(zip(journal.datagrams, MESSAGES)):
+            fields = parse(data)
+            assert fields['MESSAGE'] == text.encode('utf-8'), fields
+            assert fields['PRIORITY'] == str(log.NOTICE), fields
+            assert fields['CODE_LINE'] == str(index), fields
+        log.stdout_write('{:d} datagrams, one entry each\n'.format(len(journal.datagrams)))
+    except AssertionError as e:
+        errors.append(e)
+    finally:
+        reactor.stop()
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'journal.socket')
+        journal = Journal()
+        reactor.listenUNIXDatagram(path, journal)
+        transport = log.JournalTransport(reactor, path)
+
+        def send():
+            for index, text in enumerate(MESSAGES):
+                transport.send({'PRIORITY': log.NOTICE, 'CODE_FILE': __file__, 'CODE_LINE': index,
+                                'CODE_FUNC': 'send'}, text)
+            check(journal, transport, errors)
+
+        errors = []
+        reactor.callWhenRunning(send)
+        reactor.run()
+
+    finally:
+        shutil.rmtree(directory)
+
+    if errors:
+        sys.exit('journal check failed: {}'.format(errors[0]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Run every hot path benchmark offline against in-memory transports
+# and print the results, or write them as JSON to compare versions:
+#
+#   python benchmarks/suite.py --json before.json
+#   ... change things ...
+#   python benchmarks/suite.py --compare before.json
+#
+# Each benchmark is run with enough operations to take at least
+# --min-time seconds, --repeat times, and the best run is reported.
+
+from __future__ import absolute_import
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import parsley
+from ometa.tube import TrampolinedParser
+from twisted.internet import task
+from twisted.test import proto_helpers
+
+from txHA import log
+from txHA.bitfield import BitField
+from txHA.insteon import InsteonAddress
+from txHA.insteon import InsteonBasePLM
+from txHA.insteon import InsteonMessageFlags
+from txHA.insteon import _InsteonProtocolFactory
+from txHA.insteon.decoder import InsteonFrameDecoder
+from txHA.insteon.events import EventRegistry
+from txHA.tbq import TokenBucketQueue
+
+from bench_decoder import FRAMES
+from bench_decoder import Receiver
+
+BENCHMARKS = []
+
+# the log benchmarks set up a logger, which redirects sys.stdout
+stdout = sys.stdout
+
+def benchmark(name, unit):
+    """Register a benchmark.  The decorated function does any setup
+    and returns a function that performs a given number of
+    operations."""
+
+    def register(setup):
+        BENCHMARKS.append((name, unit, setup))
+        return setup
+    return register
+
+class Reactor(task.Clock):
+    def callWhenRunning(self, f, *args, **kw):
+        f(*args, **kw)
+
+class NullTransport(object):
+    def send(self, event, text):
+        pass
+
+def _decode(feed):
+    frames = FRAMES
+
+    def run(number):
+        for i in xrange(number):
+            feed(frames[i % len(frames)])
+    return run
+
+@benchmark('decode.grammar', 'frames/sec')
+def decode_grammar():
+    grammar = parsley.OMeta(_InsteonProtocolFactory.insteon_grammar).parseGrammar('Grammar')
+    return _decode(TrampolinedParser(grammar, Receiver(), _InsteonProtocolFactory.bindings).receive)
+
+@benchmark('decode.decoder', 'frames/sec')
+def decode_decoder():
+    return _decode(InsteonFrameDecoder(Receiver(), _InsteonProtocolFactory.bindings).feed)
+
+@benchmark('address.from_string', 'ops/sec')
+def address_from_string():
+    def run(number):
+        for i in xrange(number):
+            InsteonAddress('22.b7.00')
+    return run
+
+@benchmark('address.from_bytes', 'ops/sec')
+def address_from_bytes():
+    from_bytes = InsteonAddress.from_bytes
+
+    def run(number):
+        for i in xrange(number):
+            from_bytes('\x22\xb7\x00')
+    return run
+
+@benchmark('address.hash', 'ops/sec')
+def address_hash():
+    address = InsteonAddress('22.b7.00')
+
+    def run(number):
+        for i in xrange(number):
+            hash(address)
+    return run
+
+@benchmark('flags.from_bytes', 'ops/sec')
+def flags_from_bytes():
+    from_bytes = InsteonMessageFlags.from_bytes
+
+    def run(number):
+        for i in xrange(number):
+            flags = from_bytes('\xcb')
+            flags.message_type, flags.extended, flags.hops_left, flags.max_hops
+    return run
+
+@benchmark('flags.bitfield', 'ops/sec')
+def flags_bitfield():
+    # the way flags were decoded before the lookup table
+    def run(number):
+        for i in xrange(number):
+            bits = BitField(0xcb)
+            bits[5:8], bits[4], bits[2:4], bits[0:2]
+    return run
+
+@benchmark('tbq.put_get', 'items/sec')
+def tbq_put_get():
+    clock = task.Clock()
+    tbq = TokenBucketQueue(clock, 1e9, 1e9)
+
+    def run(number):
+        for i in xrange(number):
+            tbq.put(i)
+            tbq.get()
+    return run
+
+@benchmark('send.encode', 'messages/sec')
+def send_encode():
+    # the queue stays paused so only encoding and queueing is measured
+    plm = InsteonBasePLM(Reactor())
+    protocol = plm.factory.buildProtocol(None)
+    protocol.makeConnection(proto_helpers.StringTransport())
+    sender = protocol.sender
+    sender.tbq.pause()
+    addresses = [InsteonAddress(0x10, 0x00, i) for i in range(256)]
+
+    def clear():
+        sender.requests.clear()
+        for lane in sender.tbq.lanes:
+            # a request and its Deferred's canceller form a cycle,
+            # break it so they are freed now and not by the collector
+            for queued, request in lane:
+                request.deferred._canceller = None
+            lane.clear()
+        sender.tbq.pending = 0
+
+    # drop what has been queued every 1024 messages so memory, and
+    # with it the rate, doesn't depend on how long the run is
+    def run(number):
+        for i in xrange(number):
+            if not i & 0x3ff:
+                clear()
+            sender.sendOn(addresses[i & 0xff], i & 0xff)
+        clear()
+    return run
+
+@benchmark('events.dispatch', 'messages/sec')
+def events_dispatch():
+    # thousands of subscriptions, of which a group broadcast matches two
+    registry = EventRegistry(task.Clock())
+    addresses = [InsteonAddress(0x10, 0x00, i) for i in range(256)]
+    for i in range(5000):
+        registry.subscribe(lambda event: None, address = addresses[i & 0xff], command_1 = i % 0x60)
+    registry.subscribe(lambda event: None, group = 1)
+    address = addresses[0x11]
+    group = InsteonAddress(0x00, 0x00, 0x01)
+    flags = InsteonMessageFlags(0xcb)
+
+    def run(number):
+        for i in xrange(number):
+            registry.dispatch(address, group, flags, 0x11, 0x00)
+    return run
+
+def _log(priority, call):
+    log.logger = log.Logger(task.Clock(), log.DEBUG, 'bench', [NullTransport()])
+    log.setPriority(priority)
+
+    def run(number):
+        for i in xrange(number):
+            call('hops_left: {}', i)
+    return run
+
+@benchmark('log.emitted', 'calls/sec')
+def log_emitted():
+    return _log(log.DEBUG, log.debug)
+
+@benchmark('log.suppressed', 'calls/sec')
+def log_suppressed():
+    return _log(log.NOTICE, log.debug)
+
+def measure(setup, min_time, repeat):
+    run = setup()
+
+    # grow the number of operations until one run takes long enough
+    number = 1
+    while True:
+        start = timeit.default_timer()
+        run(number)
+        elapsed = timeit.default_timer() - start
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+
+    times = [elapsed]
+    for i in range(repeat - 1):
+        start = timeit.default_timer()
+        run(number)
+        times.append(timeit.default_timer() - start)
+
+    times.sort()
+    return {'number': number,
+            'best': number / times[0],
+            'median': number / times[len(times) // 2],
+            'runs': [number / t for t in times]}
+
+def revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                           cwd = os.path.dirname(os.path.abspath(__file__)),
+                                           stderr = devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, path, threshold):
+    with open(path) as f:
+        baseline = dict((result['name'], result) for result in json.load(f)['results'])
+
+    regressions = 0
+    for result in results:
+        before = baseline.get(result['name'])
+        if before is None:
+            continue
+        ratio = result['best'] / before['best']
+        flag = ''
+        if ratio < 1.0 - threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        stdout.write('{:20s} {:6.2f}x {}\n'.format(result['name'], ratio, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the txHA hot paths.')
+    parser.add_argument('names', nargs = '*', help = 'only run benchmarks starting with these names')
+    parser.add_argument('--min-time', type = float, default = 0.2)
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--json', help = 'write the results to this file, - for stdout')
+    parser.add_argument('--compare', help = 'compare against results written by --json')
+    parser.add_argument('--threshold', type = float, default = 0.1,
+                        help = 'slowdown that counts as a regression, 0.1 is 10%%')
+    args = parser.parse_args()
+
+    # keep the debug logging of the code under test out of the numbers
+    log.setPriority(log.WARNING)
+
+    results = []
+    for name, unit, setup in BENCHMARKS:
+        if args.names and not any(name.startswith(prefix) for prefix in args.names):
+            continue
+        result = measure(setup, args.min_time, args.repeat)
+        result.update(name = name, unit = unit)
+        results.append(result)
+        log.setPriority(log.WARNING)
+        if args.json != '-':
+            stdout.write('{:20s} {:12.0f} {}\n'.format(name, result['best'], unit))
+
+    report = {'revision': revision(),
+              'python': platform.python_version(),
+              'implementation': platform.python_implementation(),
+              'machine': platform.machine(),
+              'time': time.time(),
+              'results': results}
+
+    if args.json == '-':
+        json.dump(report, stdout, indent = 2, sort_keys = True)
+        stdout.write('\n')
+
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
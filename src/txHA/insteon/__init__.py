@@ -21,146 +21,147 @@ from twisted.internet import defer
 from twisted.internet import protocol
 from twisted.internet import serialport
 from twisted.internet import endpoints
+from twisted.python import failure
 
 import re
 import struct
 import parsley
+import functools
+import collections
 
 import pkg_resources
 
 from .. import log
-from ..bitfield import BitField
 from ..tbq import TokenBucketQueue
-
-__all__ = ['InsteonAddress', 'InsteonMessageFlags', 'InsteonDevice', 'InsteonNetworkPLM', 'InsteonSerialPLM']
+from ..tbq import INTERACTIVE
+from ..tbq import NORMAL
+from ..tbq import BACKGROUND
+from ..histogram import Histogram
+from .capture import CaptureProtocol
+from .capture import CaptureWriter
+from .database import AllLinkDatabase
+from .database import AllLinkRecord
+from .decoder import InsteonDecoderProtocol
+from .events import EventRegistry
+from .events import InsteonEvent
+from .flags import InsteonMessageFlags
+from .inventory import DeviceInventory
+from .request import InsteonError
+from .request import InsteonNAKError
+from .request import InsteonDeviceNAKError
+from .request import InsteonTimeoutError
+from .request import InsteonUnreachableError
+from .request import InsteonResponse
+from .request import InsteonStatus
+from .request import _InsteonRequest
+from .request import _InsteonGroupCommand
+from .retry import RetryPolicy
+from .retry import CircuitBreaker
+from .retry import _Retry
+
+__all__ = ['InsteonAddress', 'InsteonMessageFlags', 'InsteonDevice', 'InsteonNetworkPLM', 'InsteonSerialPLM',
+           'InsteonError', 'InsteonNAKError', 'InsteonDeviceNAKError', 'InsteonTimeoutError',
+           'InsteonUnreachableError', 'InsteonResponse', 'InsteonStatus', 'AllLinkDatabase', 'AllLinkRecord',
+           'RetryPolicy', 'InsteonEvent', 'INTERACTIVE', 'NORMAL', 'BACKGROUND']
 
 class InsteonAddress(object):
+    """An immutable three byte Insteon address.
+
+    Addresses are interned, the same three bytes always give back the
+    same object, and carry their 24-bit value, which is also their
+    hash, and their binary form.  from_bytes() skips all of the
+    argument checking for the decoder's benefit."""
+
+    __slots__ = ('value', 'binary')
+
     insteon_address_re = re.compile('([0-9a-f]{2})\.([0-9a-f]{2})\.([0-9a-f]{2})', re.IGNORECASE)
 
-    def __init__(self, high, middle = None, low = None):
+    _interned = {}
+
+    def __new__(klass, high, middle = None, low = None):
         if isinstance(high, basestring) and middle is None and low is None:
             if len(high) == 3:
-                self.high, self.middle, self.low = struct.unpack('!BBB', high)
+                return klass.from_bytes(high)
 
-            else:
-                match = self.insteon_address_re.match(high)
-                if match:
-                    self.high = int(match.group(1), 16)
-                    self.middle = int(match.group(2), 16)
-                    self.low = int(match.group(3), 16)
-                    
-                else:
-                    raise ValueError('not an insteon address?')
-        else:
-            if isinstance(high, basestring):
-                if len(high) == 1:
-                    self.high = struct.unpack('!B', high)[0]
-
-                else:
-                    raise ValueError('high part of address not single byte string')
+            match = klass.insteon_address_re.match(high)
+            if match:
+                return klass.from_bytes(chr(int(match.group(1), 16)) +
+                                        chr(int(match.group(2), 16)) +
+                                        chr(int(match.group(3), 16)))
 
-            elif isinstance(high, (int, long)):
-                if high >= 0 and high <= 255:
-                    self.high = high
+            raise ValueError('not an insteon address?')
 
-                else:
-                    raise ValueError('high part of address must be in the range [0, 255]')
+        return klass.from_bytes(klass._part('high', high) +
+                                klass._part('middle', middle) +
+                                klass._part('low', low))
 
-            else:
-                raise ValueError('high part of address must be a single byte string or an integer')
+    @staticmethod
+    def _part(name, part):
+        if isinstance(part, basestring):
+            if len(part) == 1:
+                return part
 
-            if isinstance(middle, basestring):
-                if len(middle) == 1:
-                    self.middle = struct.unpack('!B', middle)[0]
+            raise ValueError('{} part of address not single byte string'.format(name))
 
-                else:
-                    raise ValueError('middle part of address not single byte string')
+        elif isinstance(part, (int, long)):
+            if part >= 0 and part <= 255:
+                return chr(part)
 
-            elif isinstance(middle, (int, long)):
-                if middle >= 0 and middle <= 255:
-                    self.middle = middle
+            raise ValueError('{} part of address must be in the range [0, 255]'.format(name))
 
-                else:
-                    raise ValueError('middle part of address must be in the range [0, 255]')
+        raise ValueError('{} part of address must be a single byte string or an integer'.format(name))
 
-            else:
-                raise ValueError('middle part of address must be a single byte string or an integer')
+    @classmethod
+    def from_bytes(klass, binary):
+        try:
+            return klass._interned[binary]
 
-            if isinstance(low, basestring):
-                if len(low) == 1:
-                    self.low = struct.unpack('!B', low)[0]
+        except KeyError:
+            address = object.__new__(klass)
+            high, middle, low = struct.unpack('!BBB', binary)
+            object.__setattr__(address, 'value', (high << 16) | (middle << 8) | low)
+            object.__setattr__(address, 'binary', binary)
+            return klass._interned.setdefault(binary, address)
 
-                else:
-                    raise ValueError('low part of address not single byte string')
+    def __setattr__(self, name, value):
+        raise AttributeError('InsteonAddress is immutable')
 
-            elif isinstance(low, (int, long)):
-                if low >= 0 and  low <= 255:
-                    self.low = low
+    def __reduce__(self):
+        return (InsteonAddress, (self.binary,))
 
-                else:
-                    raise ValueError('low part of address must be in the range [0, 255]')
+    @property
+    def high(self):
+        return self.value >> 16
 
-            else:
-                raise ValueError('low part of address must be a single byte string or an integer')
+    @property
+    def middle(self):
+        return (self.value >> 8) & 0xff
 
     @property
-    def binary(self):
-        return struct.pack('!BBB', self.high, self.middle, self.low)
+    def low(self):
+        return self.value & 0xff
 
     def __hash__(self):
-        return hash(self.binary)
+        return self.value
 
     def __eq__(self, other):
-        return (self.high == other.high) and (self.middle == other.middle) and (self.low == other.low)
+        return self is other or (isinstance(other, InsteonAddress) and self.value == other.value)
 
     def __ne__(self, other):
-        return (self.high != other.high) or (self.middle != other.middle) or (self.low != other.low)
+        return not self.__eq__(other)
 
     def __repr__(self):
         return 'InsteonAddress(\'{:02X}.{:02X}.{:02X}\')'.format(self.high, self.middle, self.low)
 
-class InsteonMessageFlags(BitField):
-    def __init__(self, flags = 0):
-        if isinstance(flags, basestring):
-            flags = struct.unpack('!B', flags)[0]
-        super(InsteonMessageFlags, self).__init__(flags)
-
-    @property
-    def extended(self):
-        return self[4] == 1
-
-    @extended.setter
-    def extended(self, value):
-        if value:
-            self[4] = 1
-
-        else:
-            self[4] = 0
-
-    @property
-    def max_hops(self):
-        return self[0:2]
-
-    @max_hops.setter
-    def max_hops(self, value):
-        self[0:2] = value
-
-    @property
-    def hops_left(self):
-        return self[2:4]
-
-    @hops_left.setter
-    def hops_left(self, value):
-        self[2:4] = value
-
-    @property
-    def binary(self):
-        return struct.pack('!B', int(self))
-
-    def __repr__(self):
-        return 'InsteonMessageFlags(0x{:02X})'.format(int(self))
-
 class _InsteonDevice(object):
+    # seconds a known level is trusted by queryLevel()
+    state_ttl = 60.0
+
+    # direct messages are sent with the most hops any of the last
+    # hop_samples messages from the device needed, plus hop_margin to
+    # spare so a marginal delivery doesn't time out
+    hop_samples = 8
+    hop_margin = 1
 
     @classmethod
     def get(klass, plm, address):
@@ -172,85 +173,253 @@ class _InsteonDevice(object):
     def __init__(self, plm, address):
         self.plm = plm
         self.address = address
+        self.category = None
+        self.subcategory = None
+        self.firmware = None
+
+        # when the device last told us its identity, possibly in an
+        # earlier run, and when we last asked it to
+        self.verified = None
+        self.attempted = None
+        self.revalidating = False
+
+        # the last known level (0-255), when and how we learned it and
+        # when we last heard from the device at all
+        self.level = None
+        self.state_updated = None
+        self.state_source = None
+        self.last_seen = None
+        self.pending_query = None
+
+        # hops recent messages from the device took, empty until we
+        # hear from it
+        self.hops = collections.deque(maxlen = self.hop_samples)
+
+        # opened when the device stops answering and retries are on
+        self.breaker = CircuitBreaker(plm.reactor, self._probe, repr(address))
+
         self.plm.devices[address] = self
-        self.expecting = None
+        self.plm.deviceAdded(self)
+
+    @property
+    def on(self):
+        if self.level is None:
+            return None
+        return self.level > 0
+
+    def setLevel(self, level, source):
+        self.level = level
+        self.state_updated = self.plm.reactor.seconds()
+        self.state_source = source
+
+    def forgetLevel(self, source):
+        """The level changed to something we don't know, the next
+        queryLevel() asks the device."""
+
+        self.level = None
+        self.state_updated = None
+        self.state_source = source
+
+    @property
+    def max_hops(self):
+        """The max hops to send direct messages to the device with,
+        3 until we know better."""
+
+        if not self.hops:
+            return 3
+        return min(3, max(self.hops) + self.hop_margin)
+
+    def heard(self, flags):
+        """Note how many hops a message from the device needed."""
+
+        self.breaker.success()
+        before = self.max_hops
+        self.hops.append(max(0, flags.max_hops - flags.hops_left))
+        if self.max_hops != before:
+            log.debug('{!r} is {:d} hops away', self.address, self.max_hops)
+            self.plm.deviceChanged(self)
+
+    def timedOut(self, max_hops):
+        """A direct message sent with max_hops went unanswered, so
+        use one more until replies show it isn't needed."""
+
+        if self.plm.retry is not None:
+            self.breaker.failure()
+
+        if max_hops < 3 and max_hops >= self.max_hops:
+            self.hops.append(max_hops + 1 - self.hop_margin)
+            log.debug('{!r} timed out with {:d} hops, escalating', self.address, max_hops)
+            self.plm.deviceChanged(self)
+
+    def _probe(self):
+        if self.plm.protocol is None:
+            return defer.fail(InsteonUnreachableError('not connected'))
+        return self.plm.protocol._sendOnce(self.address, None, 0x0f, 0x00, priority = BACKGROUND)
+
+    def acknowledged(self, command, command_1, command_2):
+        """The device ACKed a request of ours for command."""
+
+        if command == 0x19:
+            self.setLevel(command_2, 'status')
+
+        elif command == 0x11:
+            self.setLevel(command_2, 'ack')
+
+        elif command == 0x12:
+            self.setLevel(0xff, 'ack')
+
+        elif command in (0x13, 0x14):
+            self.setLevel(0x00, 'ack')
+
+    def queryLevel(self, max_age = None, priority = NORMAL):
+        """Returns a Deferred that fires with the level of the device.
+        The known level is used if it is no older than max_age seconds
+        (state_ttl by default), otherwise the device is asked, once no
+        matter how many callers are waiting."""
+
+        if max_age is None:
+            max_age = self.state_ttl
+
+        if self.level is not None and self.plm.reactor.seconds() - self.state_updated <= max_age:
+            return defer.succeed(self.level)
+
+        if self.plm.protocol is None:
+            return defer.fail(InsteonError('PLM is not connected'))
+
+        d = defer.Deferred()
+        if self.pending_query is not None:
+            self.pending_query.append(d)
+            return d
+
+        # the request may fail right away, so wait for it only once
+        # the caller is in the list
+        self.pending_query = [d]
+        self.plm.sendStatusRequest(self.address, priority = priority).addBoth(self._queried)
+        return d
+
+    def _queried(self, result):
+        pending, self.pending_query = self.pending_query, None
+        if not isinstance(result, failure.Failure):
+            result = self.level
+        for d in pending:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def identified(self, category, subcategory, firmware):
+        self.category = category
+        self.subcategory = subcategory
+        self.firmware = firmware
+        self.verified = self.plm.reactor.seconds()
+        self.plm.deviceChanged(self)
 
     def processReceivedMessage(self, address_to, flags, command_1, command_2, user_data = None):
-        log.debug('{}{}{}'.format(flags[7], flags[6], flags[5]))
-        bgak = flags[5:8]
-        if bgak == 4:
-            log.debug('Broadcast Message')
+        bgak = flags.message_type
+        self.last_seen = self.plm.reactor.seconds()
+        self.heard(flags)
+        if log.enabled(log.DEBUG):
+            if bgak == 4:
+                log.debug('Broadcast Message')
 
-        elif bgak == 0:
-            log.debug('Direct Message')
+            elif bgak == 0:
+                log.debug('Direct Message')
 
-        elif bgak == 1:
-            log.debug('ACK of Direct Message')
+            elif bgak == 1:
+                log.debug('ACK of Direct Message')
 
-        elif bgak == 5:
-            log.debug('NAK of Direct Message')
+            elif bgak == 5:
+                log.debug('NAK of Direct Message')
 
-        elif bgak == 6:
-            log.debug('Group Broadcast Message')
+            elif bgak == 6:
+                log.debug('Group Broadcast Message')
 
-        elif bgak == 2:
-            log.debug('Group Cleanup Direct Message')
+            elif bgak == 2:
+                log.debug('Group Cleanup Direct Message')
 
-        elif bgak == 3:
-            log.debug('ACK of Group Cleanup Direct Message')
+            elif bgak == 3:
+                log.debug('ACK of Group Cleanup Direct Message')
 
-        elif bgak == 7:
-            log.debug('NAK of Group Cleanup Direct Message')
+            elif bgak == 7:
+                log.debug('NAK of Group Cleanup Direct Message')
 
-        else:
-            log.debug('unkown message type: {}'.format(bgak))
+            else:
+                log.debug('unkown message type: {}', bgak)
 
-        log.debug('extended: {}'.format(flags.extended))
-        log.debug('hops_left: {}'.format(flags.hops_left))
-        log.debug('max_hops:  {}'.format(flags.max_hops))
+            log.debug('extended: {}', flags.extended)
+            log.debug('hops_left: {}', flags.hops_left)
+            log.debug('max_hops:  {}', flags.max_hops)
 
         if bgak == 4 and command_1 == 0x01 and command_2 == 0x00:
-            self.category = address_to.high
-            self.subcategory = address_to.middle
-            self.firmware = address_to.low
-            log.debug('category   : {:02x}'.format(address_to.high))
-            log.debug('subcategory: {:02x}'.format(address_to.middle))
-            log.debug('firmware   : {:02x}'.format(address_to.low))
+            self.identified(address_to.high, address_to.middle, address_to.low)
+            log.debug('category   : {:02x}', address_to.high)
+            log.debug('subcategory: {:02x}', address_to.middle)
+            log.debug('firmware   : {:02x}', address_to.low)
 
-        elif bgak == 6 and command_1 == 0x11 and command_2 == 0x00:
-            log.debug('Turning on? {}'.format(address_to.low))
+        elif bgak == 6 and command_1 in (0x11, 0x12):
+            log.debug('Turning on? {}', address_to.low)
+            self.setLevel(0xff, 'broadcast')
 
-        elif bgak == 2 and command_1 == 0x11 and command_2 == 0x01:
+        elif bgak == 2 and command_1 in (0x11, 0x12):
             log.debug('Turning on?')
+            self.setLevel(0xff, 'cleanup')
 
-        elif bgak == 6 and command_1 == 0x13 and command_2 == 0x00:
-            log.debug('Turning off? {}'.format(address_to.low))
+        elif bgak == 6 and command_1 in (0x13, 0x14):
+            log.debug('Turning off? {}', address_to.low)
+            self.setLevel(0x00, 'broadcast')
 
-        elif bgak == 2 and command_1 == 0x13 and command_2 == 0x01:
+        elif bgak == 2 and command_1 in (0x13, 0x14):
             log.debug('Turning off?')
-
-        elif bgak == 1:
-            if self.expecting is not None:
-                if self.expecting[1] == 0x19:
-                    log.debug('database delta: {}'.format(command_1))
-                    log.debug('light level   : {}'.format(command_2))
-                    log.debug('light level   : {}%'.format(int(round(command_2 / 255.0 * 100))))
-                    self.expecting = None
+            self.setLevel(0x00, 'cleanup')
 
         elif command_1 == 0x03 and command_2 == 0x00 and user_data is not None:
-            self.category, self.subcategory, self.firmware = struct.unpack('!BBB', user_data[4:7])
+            self.identified(*struct.unpack('!BBB', user_data[4:7]))
 
-            log.debug('D1              : {:02x}'.format(struct.unpack('!B', user_data[0])[0]))
-            log.debug('D2-4 product key: {}'.format(`user_data[1:4]`))
-            log.debug('D5   category   : {:02x}'.format(struct.unpack('!B', user_data[4])[0]))
-            log.debug('D6   subcategory: {:02x}'.format(struct.unpack('!B', user_data[5])[0]))
-            log.debug('D7   firmware   : {:02x}'.format(struct.unpack('!B', user_data[6])[0]))
-            log.debug('D8-14           : {}'.format(`user_data[7:14]`))
+            log.debug('D1              : {:02x}', struct.unpack('!B', user_data[0])[0])
+            log.debug('D2-4 product key: {!r}', user_data[1:4])
+            log.debug('D5   category   : {:02x}', struct.unpack('!B', user_data[4])[0])
+            log.debug('D6   subcategory: {:02x}', struct.unpack('!B', user_data[5])[0])
+            log.debug('D7   firmware   : {:02x}', struct.unpack('!B', user_data[6])[0])
+            log.debug('D8-14           : {!r}', user_data[7:14])
 
 def InsteonDevice(plm, address):
     return _InsteonDevice.get(plm, address)
 
 class _InsteonBaseProtocol(object):
+    # seconds to wait for the PLM echo and the device reply after a
+    # request has been written
+    timeout = 10.0
+
+    # with coalescing on, a state-setting command replaces one that is
+    # still queued for the same device and identical read-only queries
+    # share a single wire transaction
+    state_commands = (0x11, 0x12, 0x13, 0x14, 0x21)
+    query_commands = (0x03, 0x0d, 0x0f, 0x10, 0x19)
+
+    # PLM reports after which its ALL-Link database has to be read again
+    all_link_changes = ('all_linking_completed', 'manage_all_link_record_echo',
+                        'reset_the_im_echo', 'user_reset_detected')
+
+    # after a group broadcast the PLM cleans up each member in turn,
+    # allow this long for the cleanups plus this long per member
+    cleanup_timeout = 2.0
+    cleanup_per_member = 0.5
+
+    # a group is only used for a scene if it covers at least this many
+    # of the target devices, fewer are sent direct messages
+    min_group_size = 2
+
+    # with pacing on only one frame is outstanding at a time and the
+    # next one goes out as soon as the PLM echoes the previous one.
+    # The send rate grows by rate_step for every ACKed echo up to
+    # max_rate and is halved (down to min_rate) after a NAK or when
+    # no echo arrives within echo_timeout seconds, in which case
+    # nothing is sent for backoff seconds either.
+    min_rate = 1.0
+    rate_step = 0.5
+    echo_timeout = 1.0
+    backoff = 0.5
+
     def __init__(self, reactor, transport, plm):
         self.reactor = reactor
         self.plm = plm
@@ -260,8 +429,29 @@ class _InsteonBaseProtocol(object):
         self.parser = None
         self.currentRule = 'receive'
 
+        # outstanding requests keyed by (address, command_1), PLM
+        # commands use None for the address.  Each key maps to a list
+        # of requests in the order they were queued.
+        self.requests = {}
+        self.coalesce = plm.coalesce
+        self.pacing = plm.pacing
+        self.retry = plm.retry
+        self.max_rate = plm.max_rate
+        self.awaiting_echo = None
+        self.echo_call = None
+
+        # counters and histograms reported by getMetrics()
+        self.frames_out = collections.defaultdict(int)
+        self.naks = {'plm': 0, 'device': 0}
+        self.timeouts = {'plm': 0, 'device': 0}
+        self.echo_latency = Histogram()
+        self.ack_latency = Histogram()
+
         self.more_all_link_records = False
 
+        # group broadcasts waiting for their cleanups, oldest first
+        self.group_commands = []
+
         self.reactor.callWhenRunning(self.start)
 
     def prepareParsing(self, parser):
@@ -271,7 +461,12 @@ class _InsteonBaseProtocol(object):
 
     def finishParsing(self, reason):
         log.err(reason)
-        pass
+        if self.echo_call is not None and self.echo_call.active():
+            self.echo_call.cancel()
+        self.echo_call = None
+        for requests in self.requests.values():
+            for request in list(requests):
+                request.fail(reason)
 
     def start(self):
         self._getMessage()
@@ -280,127 +475,528 @@ class _InsteonBaseProtocol(object):
         d = self.tbq.get()
         d.addCallback(self._gotMessage)
 
-    def _gotMessage(self, message):
-        self.reactor.callLater(0.0, self._getMessage)
-        self.transport.write(message)
+    def _gotMessage(self, request):
+        if request.finished:
+            self.reactor.callLater(0.0, self._getMessage)
+            return
 
-    def _sendMessage(self, address, flags, command_1, command_2, user_data = None):
+        request.write(self.transport)
+        self.frames_out[request.message[1]] += 1
+
+        if self.pacing:
+            self.awaiting_echo = request
+            self.echo_call = self.reactor.callLater(self.echo_timeout, self._echoTimedOut)
+
+        else:
+            self.reactor.callLater(0.0, self._getMessage)
+
+    def _echoed(self, acknak):
+        if self.awaiting_echo is None:
+            return
+
+        self.awaiting_echo = None
+        if self.echo_call is not None and self.echo_call.active():
+            self.echo_call.cancel()
+        self.echo_call = None
+
+        if acknak:
+            self.tbq.setRate(min(self.max_rate, self.tbq.token_rate + self.rate_step))
+            self.reactor.callLater(0.0, self._getMessage)
+
+        else:
+            self._backOff()
+
+    def _echoTimedOut(self):
+        log.debug('no echo from the PLM, backing off')
+        self.echo_call = None
+        self.awaiting_echo = None
+        self._backOff()
+
+    def _backOff(self):
+        self.tbq.setRate(max(self.min_rate, self.tbq.token_rate / 2.0))
+        self.reactor.callLater(self.backoff, self._getMessage)
+
+    def _request(self, key, message, timeout = None, response = None, priority = NORMAL):
+        if timeout is None:
+            timeout = self.timeout
+        request = _InsteonRequest(self, key, message, timeout, response, priority)
+        self.requests.setdefault(key, []).append(request)
+        self.tbq.put(request, priority)
+        return request.deferred
+
+    def _coalesce(self, address, command_1, message, timeout, response, priority):
+        if command_1 in self.query_commands:
+            for request in self.requests.get((address, command_1), ()):
+                if not request.finished and request.message == message:
+                    log.debug('sharing {!r} with an outstanding request', request.key)
+                    return request.follow()
+
+        elif command_1 in self.state_commands:
+            for command in self.state_commands:
+                for request in self.requests.get((address, command), ()):
+                    if request.sent or request.finished:
+                        continue
+
+                    log.debug('{!r} superseded by 0x{:02x}', request.key, command_1)
+                    self._removeRequest(request)
+
+                    if request.priority <= priority:
+                        # rewrite the queued request in place, it
+                        # keeps its place in the queue
+                        request.key = (address, command_1)
+                        request.message = message
+                        request.timeout = timeout
+                        request.response = response
+                        self.requests.setdefault(request.key, []).append(request)
+                        return request.follow()
+
+                    # the new command is more urgent, drop the queued
+                    # one and let its caller follow the new request
+                    request.finished = True
+                    d = self._request((address, command_1), message, timeout, response, priority)
+                    replacement = self.requests[(address, command_1)][-1]
+                    replacement.followers.append(request.deferred)
+                    replacement.followers.extend(request.followers)
+                    request.followers = []
+                    return d
+
+        return None
+
+    def _requestTimedOut(self, request):
+        # no echo means the PLM never took the request
+        if request.echoed:
+            self.timeouts['device'] += 1
+            if request.message[1] == '\x62':
+                device = self.plm.devices.get(request.key[0])
+                if device is not None:
+                    device.timedOut(InsteonMessageFlags.from_bytes(request.message[5]).max_hops)
+        else:
+            self.timeouts['plm'] += 1
+
+    def _observeEcho(self, request):
+        self.echo_latency.observe(self.reactor.seconds() - request.sent_at)
+
+    def getMetrics(self):
+        """Return a snapshot of the counters and histograms of this
+        connection, see metrics.render() for a text version."""
+
+        frames_in = {}
+        discarded = resyncs = 0
+
+        # only the table driven decoder keeps statistics
+        decoder = getattr(self.parser, 'decoder', None)
+        if decoder is not None:
+            frames_in = dict((ord(command), count) for command, count in decoder.received.items())
+            discarded = decoder.discarded
+            resyncs = decoder.resyncs
+
+        return {'frames_in': frames_in,
+                'frames_out': dict((ord(command), count) for command, count in self.frames_out.items()),
+                'naks': dict(self.naks),
+                'timeouts': dict(self.timeouts),
+                'decoder': {'discarded': discarded, 'resyncs': resyncs},
+                'outstanding': sum(len(requests) for requests in self.requests.values()),
+                'send_rate': self.tbq.token_rate,
+                'queue_depth': self.tbq.depth(),
+                'queue': self.tbq.stats(),
+                'echo_latency': self.echo_latency.snapshot(),
+                'ack_latency': self.ack_latency.snapshot()}
+
+    def _removeRequest(self, request):
+        requests = self.requests.get(request.key)
+        if requests is None or request not in requests:
+            return
+        requests.remove(request)
+        if not requests:
+            del self.requests[request.key]
+
+    def _findRequest(self, key, echoed):
+        for request in self.requests.get(key, ()):
+            if request.sent and request.echoed == echoed:
+                return request
+        return None
+
+    def _sendMessage(self, address, flags, command_1, command_2, user_data = None, timeout = None, response = InsteonResponse, priority = NORMAL):
+        if self.retry is None:
+            return self._sendOnce(address, flags, command_1, command_2, user_data, timeout, response, priority)
+
+        # nothing goes to a device that stopped answering, it is
+        # probed in the background instead
+        device = InsteonDevice(self.plm, address)
+        if device.breaker.open:
+            return defer.fail(InsteonUnreachableError('{!r} is not answering'.format(address)))
+
+        send = functools.partial(self._sendOnce, address, flags, command_1, command_2, user_data, timeout, response, priority)
+        return _Retry(self, self.retry, device.breaker, send).start()
+
+    def _sendOnce(self, address, flags, command_1, command_2, user_data = None, timeout = None, response = InsteonResponse, priority = NORMAL):
         if flags is None:
-            flags = InsteonMessageFlags(0x0f)
+            # as few hops as the device has needed lately
+            device = self.plm.devices.get(address)
+            hops = 3 if device is None else device.max_hops
+            flags = InsteonMessageFlags((hops << 2) | hops)
 
         if user_data is None:
-            flags.extended = False
+            flags = flags.replace(extended = False)
             msg = struct.pack('!BB3scBB', 0x02, 0x62, address.binary, flags.binary, command_1, command_2)
 
         else:
-            flags.extended = True
+            flags = flags.replace(extended = True)
             if len(user_data) < 14:
-                userdata += '\x00' * (14 - len(user_data))
+                user_data += '\x00' * (14 - len(user_data))
 
             elif len(user_data) > 14:
                 raise ValueError('user_data is too long!')
 
             msg = struct.pack('!BB3scBB14s', 0x02, 0x62, address.binary, flags.binary, command_1, command_2, user_data)
 
-        self.tbq.put(msg)
-
-    def sendGetFirstAllLinkRecord(self):
+        if self.coalesce:
+            if timeout is None:
+                timeout = self.timeout
+            d = self._coalesce(address, command_1, msg, timeout, response, priority)
+            if d is not None:
+                return d
+
+        return self._request((address, command_1), msg, timeout, response, priority)
+
+    def sendAllLinkCommand(self, group, command_1, command_2 = 0x00, timeout = None, priority = NORMAL):
+        msg = struct.pack('!BBBBB', 0x02, 0x61, group, command_1, command_2)
+        return self._request((None, 0x61), msg, timeout, priority = priority)
+
+    def _findGroup(self, targets):
+        """Return the group and its members that switches the most of
+        targets without touching anything else, or None."""
+
+        best = None
+        best_members = frozenset()
+        db = self.plm.all_link_db
+        for group in db.groups():
+            members = frozenset(db.responders(group))
+            if len(members) < self.min_group_size or not members <= targets:
+                continue
+            if len(members) > len(best_members):
+                best = group
+                best_members = members
+        return best, best_members
+
+    def sendScene(self, addresses, command_1 = 0x11, command_2 = 0xff, timeout = None, priority = NORMAL):
+        """Send command_1 to all of addresses, as one group broadcast
+        if the cached ALL-Link database has a group made up of them.
+        Members that don't ACK the PLM's cleanup, and targets that
+        aren't in the group, get a direct message with command_1 and
+        command_2 instead.
+
+        Group responders turn on to the on-level of their own link
+        record rather than to command_2, so the group is only used to
+        turn on with command_2 0xff and to turn off.
+
+        Returns a Deferred that fires with a dict of address -> True
+        for members that ACKed the group cleanup, the InsteonResponse
+        of a direct message or a Failure."""
+
+        targets = frozenset(addresses)
+        if (command_1 in (0x11, 0x12) and command_2 == 0xff) or command_1 in (0x13, 0x14):
+            group, members = self._findGroup(targets)
+        else:
+            group, members = None, frozenset()
+        results = {}
+
+        def direct(addresses):
+            ds = []
+            for address in addresses:
+                d = self._sendMessage(address, None, command_1, command_2, timeout = timeout, priority = priority)
+                d.addBoth(self._storeResult, results, address)
+                ds.append(d)
+            return defer.DeferredList(ds)
+
+        ds = [direct(targets - members)]
+
+        if group is not None:
+            log.debug('sending 0x{:02x} to group {:d} for {:d} devices', command_1, group, len(members))
+            timeout = self.cleanup_timeout + self.cleanup_per_member * len(members)
+            command = _InsteonGroupCommand(self, group, command_1, members, timeout)
+            self.group_commands.append(command)
+            self.sendAllLinkCommand(group, command_1, 0x00, priority = priority).addCallbacks(command.echoed, command.fail)
+
+            def cleanedUp(missed):
+                for address in command.acked:
+                    results[address] = True
+                    if command_1 == 0x11:
+                        # the on-level is in the responder's link record,
+                        # which we don't have
+                        InsteonDevice(self.plm, address).forgetLevel('group')
+                    elif command_1 == 0x12:
+                        InsteonDevice(self.plm, address).setLevel(0xff, 'group')
+                    elif command_1 in (0x13, 0x14):
+                        InsteonDevice(self.plm, address).setLevel(0x00, 'group')
+
+                # targeted cleanups for the members that missed it
+                return direct(missed)
+
+            ds.append(command.deferred.addCallback(cleanedUp))
+
+        d = defer.DeferredList(ds)
+        d.addCallback(lambda result: results)
+        return d
+
+    def _storeResult(self, result, results, address):
+        results[address] = result
+
+    def _removeGroupCommand(self, command):
+        if command in self.group_commands:
+            self.group_commands.remove(command)
+
+    def _findGroupCommand(self, group):
+        for command in self.group_commands:
+            if command.group == group and command.delayed_call is not None:
+                return command
+        return None
+
+    def sendGetFirstAllLinkRecord(self, timeout = None, priority = BACKGROUND):
         msg = struct.pack('!BB', 0x02, 0x69)
-        self.tbq.put(msg)
+        self.plm.all_link_db.startWalk()
+        d = self._request((None, 0x69), msg, timeout, priority = priority)
+        d.addErrback(self._walkFailed)
+        return d
 
-    def sendGetNextAllLinkRecord(self):
+    def sendGetNextAllLinkRecord(self, timeout = None, priority = BACKGROUND):
         msg = struct.pack('!BB', 0x02, 0x6a)
-        self.tbq.put(msg)
+        return self._request((None, 0x6a), msg, timeout, priority = priority)
 
-    def sendGetProductDataRequest(self, address, flags = None):
-        self._sendMessage(address, flags, 0x03, 0x00)
+    def sendGetProductDataRequest(self, address, flags = None, timeout = None, priority = NORMAL):
+        return self._sendMessage(address, flags, 0x03, 0x00, timeout = timeout, priority = priority)
 
-    def sendFxNameRequest(self, address, flags = None):
-        self._sendMessage(address, flags, 0x03, 0x01)
+    def sendFxNameRequest(self, address, flags = None, timeout = None, priority = NORMAL):
+        return self._sendMessage(address, flags, 0x03, 0x01, timeout = timeout, priority = priority)
 
-    def sendDeviceTextStringRequest(self, address, flags = None):
-        self._sendMessage(address, flags, 0x03, 0x02)
+    def sendDeviceTextStringRequest(self, address, flags = None, timeout = None, priority = NORMAL):
+        return self._sendMessage(address, flags, 0x03, 0x02, timeout = timeout, priority = priority)
 
-    def sendGetInsteonEngineVersion(self, address, flags = None):
-        self._sendMessage(address, flags, 0x0d, 0x00)
+    def sendGetInsteonEngineVersion(self, address, flags = None, timeout = None, priority = NORMAL):
+        return self._sendMessage(address, flags, 0x0d, 0x00, timeout = timeout, priority = priority)
 
-    def sendPing(self, address, flags = None):
-        self._sendMessage(address, flags, 0x0f, 0x00)
+    def sendPing(self, address, flags = None, timeout = None, priority = NORMAL):
+        return self._sendMessage(address, flags, 0x0f, 0x00, timeout = timeout, priority = priority)
 
-    def sendIDRequest(self, address, flags = None):
-        self._sendMessage(address, flags, 0x10, 0x00)
+    def sendIDRequest(self, address, flags = None, timeout = None, priority = NORMAL):
+        return self._sendMessage(address, flags, 0x10, 0x00, timeout = timeout, priority = priority)
 
-    def sendOn(self, address, level = 0xff, flags = None):
-        self._sendMessage(address, flags, 0x11, level)
+    def sendOn(self, address, level = 0xff, flags = None, timeout = None, priority = NORMAL):
+        return self._sendMessage(address, flags, 0x11, level, timeout = timeout, priority = priority)
 
-    def sendOff(self, address, flags = None):
-        self._sendMessage(address, flags, 0x13, 0x00)
+    def sendOff(self, address, flags = None, timeout = None, priority = NORMAL):
+        return self._sendMessage(address, flags, 0x13, 0x00, timeout = timeout, priority = priority)
 
-    def sendFastOff(self, address, flags = None):
-        self._sendMessage(address, flags, 0x14, 0x00)
+    def sendFastOff(self, address, flags = None, timeout = None, priority = NORMAL):
+        return self._sendMessage(address, flags, 0x14, 0x00, timeout = timeout, priority = priority)
 
-    def sendBright(self, address, flags = None):
-        self._sendMessage(address, flags, 0x15, 0x00)
+    def sendBright(self, address, flags = None, timeout = None, priority = NORMAL):
+        return self._sendMessage(address, flags, 0x15, 0x00, timeout = timeout, priority = priority)
 
-    def sendDim(self, address, flags = None):
-        self._sendMessage(address, flags, 0x16, 0x00)
+    def sendDim(self, address, flags = None, timeout = None, priority = NORMAL):
+        return self._sendMessage(address, flags, 0x16, 0x00, timeout = timeout, priority = priority)
 
-    def sendStartManualChangeDim(self, address, flags = None):
-        self._sendMessage(address, flags, 0x17, 0x00)
+    def sendStartManualChangeDim(self, address, flags = None, timeout = None, priority = NORMAL):
+        return self._sendMessage(address, flags, 0x17, 0x00, timeout = timeout, priority = priority)
 
-    def sendStartManualChangeBright(self, address, flags = None):
-        self._sendMessage(address, flags, 0x17, 0x01)
+    def sendStartManualChangeBright(self, address, flags = None, timeout = None, priority = NORMAL):
+        return self._sendMessage(address, flags, 0x17, 0x01, timeout = timeout, priority = priority)
 
-    def sendStopManualChange(self, address, flags = None):
-        self._sendMessage(address, flags, 0x18, 0x00)
+    def sendStopManualChange(self, address, flags = None, timeout = None, priority = NORMAL):
+        return self._sendMessage(address, flags, 0x18, 0x00, timeout = timeout, priority = priority)
 
-    def sendStatusRequest(self, address, kpl_led = False, flags = None):
+    def sendStatusRequest(self, address, kpl_led = False, flags = None, timeout = None, priority = NORMAL):
         if kpl_led:
             command_2 = 0x01
 
         else:
             command_2 = 0x00
 
-        self._sendMessage(address, flags, 0x19, command_2)
-        
-    def sendGetIMInfo(self):
+        return self._sendMessage(address, flags, 0x19, command_2, timeout = timeout, response = InsteonStatus, priority = priority)
+
+    def sendGetIMInfo(self, timeout = None, priority = NORMAL):
         msg = struct.pack('!BB', 0x02, 0x60)
-        self.tbq.put(msg)
+        return self._request((None, 0x60), msg, timeout, priority = priority)
+
+    def syncAllLinkDatabase(self, force = False):
+        """Returns a Deferred that fires with the PLM's ALL-Link
+        database, walking it first only if the cached copy is out of
+        date."""
+
+        db = self.plm.all_link_db
+        if force:
+            db.invalidate('refresh requested')
+
+        d = db.wait()
+        if not db.complete and db.walk is None:
+            # failures reach the caller through db.wait()
+            self.sendGetFirstAllLinkRecord().addErrback(lambda reason: None)
+        return d
+
+    def _walkFailed(self, reason):
+        self.plm.all_link_db.failWalk(reason)
+        return reason
+
+    def _allLinkDatabaseChanged(self, reason):
+        self.plm.all_link_db.invalidate(reason)
+        self.syncAllLinkDatabase().addErrback(log.err)
 
     def receive(self, *args):
-        log.debug(`args`)
+        log.debug('{!r}', args)
+        if args[0] in self.all_link_changes:
+            self._allLinkDatabaseChanged(args[0])
+
+    def receiveIMInfo(self, address, category, subcategory, firmware, acknak):
+        log.debug('{!r}', ('receiveIMInfo', address, category, subcategory, firmware, acknak))
+        self._echoed(acknak)
+        if not acknak:
+            self.naks['plm'] += 1
+
+        request = self._findRequest((None, 0x60), False)
+        if request is None:
+            return
+
+        self._observeEcho(request)
+
+        if acknak:
+            request.finish((address, category, subcategory, firmware))
+
+        else:
+            request.fail(InsteonNAKError('PLM NAKed IM info request'))
 
     def receiveMessageEcho(self, address, flags, command_1, command_2, acknak, user_data = None):
-        log.debug(`('receiveMessageEcho', address, flags, command_1, command_2, acknak, user_data)`)
-        if acknak and command_1 == 0x19:
-            device = InsteonDevice(self.plm, address)
-            device.expecting = (flags, command_1, command_2, user_data)
+        log.debug('{!r}', ('receiveMessageEcho', address, flags, command_1, command_2, acknak, user_data))
+        self._echoed(acknak)
+        if not acknak:
+            self.naks['plm'] += 1
+
+        request = self._findRequest((address, command_1), False)
+        if request is None:
+            log.debug('echo does not match any outstanding request')
+            return
+
+        self._observeEcho(request)
+
+        if not acknak:
+            request.fail(InsteonNAKError('PLM NAKed {!r}'.format(request.key)))
+
+        elif request.expects_reply:
+            request.echoed = True
+
+        else:
+            request.finish(True)
 
     def receiveMessage(self, address_from, address_to, flags, command_1, command_2, user_data = None):
-        log.debug(`('receiveMessage', address_from, address_to, flags, command_1, command_2, user_data)`)
+        log.debug('{!r}', ('receiveMessage', address_from, address_to, flags, command_1, command_2, user_data))
         device_from = InsteonDevice(self.plm, address_from)
+        bgak = flags.message_type
+        if bgak == InsteonMessageFlags.DIRECT_ACK or bgak == InsteonMessageFlags.DIRECT_NAK:
+            # status requests are answered with the database delta in
+            # command 1 so they can't be matched on it
+            request = self._findRequest((address_from, command_1), True)
+            if request is None:
+                request = self._findRequest((address_from, 0x19), True)
+
+            if bgak == InsteonMessageFlags.DIRECT_NAK:
+                self.naks['device'] += 1
+
+            if request is not None:
+                self.ack_latency.observe(self.reactor.seconds() - request.sent_at)
+                if bgak == InsteonMessageFlags.DIRECT_ACK:
+                    if request.key[1] == 0x19 and self.plm.all_link_db.noteDelta(address_from, command_1):
+                        self._allLinkDatabaseChanged('database delta of {!r} changed'.format(address_from))
+                    # only the request tells what an ACK acknowledges
+                    device_from.acknowledged(request.key[1], command_1, command_2)
+                    request.finish(request.response(address_from, flags, command_1, command_2, user_data))
+
+                else:
+                    request.fail(InsteonDeviceNAKError('device NAKed {!r}'.format(request.key)))
+
+        elif bgak == InsteonMessageFlags.GROUP_CLEANUP_ACK:
+            command = self._findGroupCommand(command_2)
+            if command is not None and command.command_1 == command_1:
+                command.cleanedUp(address_from)
+
         device_from.processReceivedMessage(address_to, flags, command_1, command_2, user_data)
+        self.plm.events.dispatch(address_from, address_to, flags, command_1, command_2, user_data)
+
+    def receiveAllLinkCommandEcho(self, group, command_1, command_2, acknak):
+        log.debug('{!r}', ('receiveAllLinkCommandEcho', group, command_1, command_2, acknak))
+        self._echoed(acknak)
+        if not acknak:
+            self.naks['plm'] += 1
+
+        request = self._findRequest((None, 0x61), False)
+        if request is None:
+            return
+
+        self._observeEcho(request)
+        if acknak:
+            request.finish(True)
+        else:
+            request.fail(InsteonNAKError('PLM NAKed group {:d} command 0x{:02x}'.format(group, command_1)))
+
+    def receiveAllLinkCleanupFailureReport(self, group, address):
+        log.debug('{!r}', ('receiveAllLinkCleanupFailureReport', group, address))
+
+    def receiveAllLinkCleanupStatusReport(self, acknak):
+        log.debug('{!r}', ('receiveAllLinkCleanupStatusReport', acknak))
+        # the PLM is done with the cleanups of the oldest broadcast,
+        # whoever hasn't ACKed by now has missed it
+        for command in self.group_commands:
+            if command.delayed_call is not None:
+                command.finish()
+                break
 
     def receiveAllLinkRecordEcho(self, acknak):
-        log.debug(`('receiveAllLinkRecordEcho', acknak)`)
+        log.debug('{!r}', ('receiveAllLinkRecordEcho', acknak))
+        # a NAK here is the end of the database, not a busy PLM
+        self._echoed(True)
         self.more_all_link_records = acknak
+        if not acknak and not self.plm.all_link_db.finishWalk():
+            self.syncAllLinkDatabase().addErrback(log.err)
+        request = self._findRequest((None, 0x69), False)
+        if request is None:
+            request = self._findRequest((None, 0x6a), False)
+
+        # a NAK here just means there are no (more) records
+        if request is not None:
+            self._observeEcho(request)
+            request.finish(acknak)
 
     def receiveAllLinkRecord(self, all_link_record_flags, all_link_group, address, link_data):
-        log.debug(`('receiveAllLinkRecord', all_link_record_flags, all_link_group, address, link_data)`)
+        log.debug('{!r}', ('receiveAllLinkRecord', all_link_record_flags, all_link_group, address, link_data))
+        self.plm.all_link_db.walked(AllLinkRecord(all_link_record_flags, all_link_group, address, link_data))
         if self.more_all_link_records:
-            self.sendGetNextAllLinkRecord()
+            self.sendGetNextAllLinkRecord().addErrback(self._walkFailed).addErrback(log.err)
 
 class _InsteonProtocolFactory(protocol.ClientFactory):
     insteon_grammar = pkg_resources.resource_string(__name__, 'grammar.txt')
 
-    def __init__(self, reactor, plm):
+    bindings = {'InsteonAddress': InsteonAddress,
+                'InsteonMessageFlags': InsteonMessageFlags}
+
+    def __init__(self, reactor, plm, grammar = False, capture = None):
         self.reactor = reactor
         self.plm = plm
-        self.protocol = parsley.makeProtocol(self.insteon_grammar,
-                                             self.senderFactory,
-                                             self.receiverFactory,
-                                             {'InsteonAddress': InsteonAddress,
-                                              'InsteonMessageFlags': InsteonMessageFlags})
+
+        # path of a file that every frame read or written is appended
+        # to, see capture.py
+        self.capture = capture
+
+        # the parsley grammar is kept as a reference implementation of
+        # the receive path, the table driven decoder is much faster
+        if grammar:
+            self.protocol = parsley.makeProtocol(self.insteon_grammar,
+                                                 self.senderFactory,
+                                                 self.receiverFactory,
+                                                 self.bindings)
+
+        else:
+            self.protocol = functools.partial(InsteonDecoderProtocol,
+                                              self.senderFactory,
+                                              self.receiverFactory,
+                                              self.bindings)
 
     def senderFactory(self, transport):
         base = _InsteonBaseProtocol(self.reactor, transport, self.plm)
@@ -412,44 +1008,206 @@ class _InsteonProtocolFactory(protocol.ClientFactory):
     
     def buildProtocol(self, addr):
         log.debug('buildProtocol')
-        return self.protocol()
+        p = self.protocol()
+        if self.capture is not None:
+            p = CaptureProtocol(CaptureWriter(self.capture, self.reactor.seconds), p)
+        return p
 
 class InsteonBasePLM(object):
-    def __init__(self, reactor):
+    # with an inventory file, changes are written out this many seconds
+    # after they happen so a burst of them costs one write
+    save_delay = 5.0
+
+    # devices whose identity hasn't been confirmed for revalidate_after
+    # seconds, or only comes from the inventory file, are asked for it
+    # again in the background, one every revalidate_interval seconds
+    revalidate_after = 7 * 24 * 3600.0
+    revalidate_interval = 10.0
+
+    # a device that didn't answer its ID request is asked again after
+    # this many seconds
+    revalidate_retry = 3600.0
+
+    def __init__(self, reactor, grammar = False, coalesce = False, pacing = False, max_rate = 8.0, capture = None,
+                 inventory = None, all_link_db = None, retry = None):
         self.reactor = reactor
+        self.coalesce = coalesce
+        self.pacing = pacing
+        self.max_rate = max_rate
+
+        # a RetryPolicy for direct messages, which also parks traffic to
+        # devices that stopped answering
+        self.retry = retry
         self.ready = defer.Deferred()
         self.ready.addCallback(self._connected)
         self.protocol = None
         self.devices = {}
-        self.factory = _InsteonProtocolFactory(self.reactor, self)
+        self.events = EventRegistry(reactor)
+        self.factory = _InsteonProtocolFactory(self.reactor, self, grammar, capture)
+
+        self.inventory = None
+        self.save_call = None
+        self.revalidate_call = None
+        if inventory is not None:
+            self.inventory = DeviceInventory(inventory)
+            self._loadInventory()
+            self.reactor.addSystemEventTrigger('before', 'shutdown', self.saveInventory)
+
+        # the PLM's ALL-Link database, kept in all_link_db if that is a
+        # path
+        self.all_link_db = AllLinkDatabase(all_link_db)
+        if all_link_db is not None:
+            self.all_link_db.load()
+            self.reactor.addSystemEventTrigger('before', 'shutdown', self.all_link_db.save)
 
     def _connected(self, protocol):
         self.protocol = protocol
+        if self.inventory is not None:
+            self._scheduleRevalidation()
+        if not self.all_link_db.complete:
+            protocol.syncAllLinkDatabase().addErrback(log.err)
         return self
 
+    def _loadInventory(self):
+        entries = self.inventory.load()
+        for binary, (category, subcategory, firmware, verified, hops) in entries.items():
+            device = InsteonDevice(self, InsteonAddress.from_bytes(binary))
+            device.category = category
+            device.subcategory = subcategory
+            device.firmware = firmware
+            device.verified = verified
+            if hops is not None:
+                device.hops.append(hops)
+        log.informational('loaded {:d} devices from {}', len(entries), self.inventory.path)
+
+    def queryLevel(self, address, max_age = None, priority = NORMAL):
+        return InsteonDevice(self, address).queryLevel(max_age, priority)
+
+    def subscribe(self, callback, address = None, group = None, command_1 = None, message_type = None):
+        """Call callback with an InsteonEvent for each message from a
+        device that matches all of the given sender address, group,
+        command 1 and message type (one of the InsteonMessageFlags
+        constants).  Returns a Subscription with a cancel() method."""
+
+        return self.events.subscribe(callback, address, group, command_1, message_type)
+
+    def deviceAdded(self, device):
+        # a new device may need identifying long before the next
+        # scheduled look
+        if self.inventory is not None and self.protocol is not None:
+            self._scheduleRevalidation()
+
+    def deviceChanged(self, device):
+        if self.inventory is None:
+            return
+        if self.save_call is None:
+            self.save_call = self.reactor.callLater(self.save_delay, self.saveInventory)
+
+    def saveInventory(self):
+        if self.save_call is not None and self.save_call.active():
+            self.save_call.cancel()
+        self.save_call = None
+
+        if self.inventory is None:
+            return
+
+        entries = {}
+        for address, device in self.devices.items():
+            if device.category is None:
+                continue
+            hops = max(device.hops) if device.hops else None
+            entries[address.binary] = (device.category, device.subcategory, device.firmware, device.verified, hops)
+        self.inventory.save(entries)
+
+    def _scheduleRevalidation(self):
+        if any(device.revalidating for device in self.devices.values()):
+            # done() schedules the next look
+            return
+
+        if self.revalidate_call is not None and self.revalidate_call.active():
+            # pull a far off look in
+            if self.revalidate_call.getTime() > self.reactor.seconds() + self.revalidate_interval:
+                self.revalidate_call.reset(self.revalidate_interval)
+            return
+
+        self.revalidate_call = self.reactor.callLater(self.revalidate_interval, self._revalidate)
+
+    def _revalidationDue(self, device):
+        due = 0.0
+        if device.verified is not None:
+            due = device.verified + self.revalidate_after
+        if device.attempted is not None and (device.verified is None or device.verified < device.attempted):
+            # the last attempt failed
+            due = max(due, device.attempted + self.revalidate_retry)
+        return due
+
+    def _revalidate(self):
+        self.revalidate_call = None
+        if self.protocol is None:
+            return
+
+        # the least recently confirmed device first, one at a time and
+        # at background priority so it never gets in the way.  Devices
+        # we know nothing about yet are asked too.
+        now = self.reactor.seconds()
+        oldest = None
+        wake = None
+        for device in self.devices.values():
+            if device.revalidating:
+                continue
+            due = self._revalidationDue(device)
+            if due > now:
+                wake = due if wake is None else min(wake, due)
+                continue
+            if oldest is None or (device.verified or 0.0) < (oldest.verified or 0.0):
+                oldest = device
+
+        if oldest is None:
+            # nothing is stale now, look again when something will be,
+            # new devices bring that forward
+            if wake is not None:
+                delay = max(self.revalidate_interval, wake - now)
+                self.revalidate_call = self.reactor.callLater(delay, self._revalidate)
+            return
+
+        device = oldest
+        device.revalidating = True
+        device.attempted = now
+        d = self.protocol.sendIDRequest(device.address, priority = BACKGROUND)
+
+        def done(result):
+            device.revalidating = False
+            self._scheduleRevalidation()
+
+        d.addErrback(lambda reason: log.debug('revalidating {!r} failed: {}', device.address, reason.getErrorMessage()))
+        d.addBoth(done)
+
     def __getattr__(self, name):
         if self.protocol is not None:
             return getattr(self.protocol, name)
         raise AttributeError
 
 class InsteonNetworkPLM(InsteonBasePLM):
-    def __init__(self, reactor, hostname, port = 9761):
+    def __init__(self, reactor, hostname, port = 9761, grammar = False, coalesce = False, pacing = False, max_rate = 8.0,
+                 capture = None, inventory = None, all_link_db = None, retry = None):
         self.hostname = hostname
         self.port = port
 
-        super(InsteonNetworkPLM, self).__init__(reactor)
+        super(InsteonNetworkPLM, self).__init__(reactor, grammar, coalesce, pacing, max_rate, capture, inventory,
+                                                all_link_db, retry)
 
         endpoint = endpoints.clientFromString(reactor, 'tcp:host={}:port={}'.format(self.hostname, self.port))
         endpoint.connect(self.factory)
 
-class InsteonSerialPLM(object):
-    def __init__(self, reactor, devicename):
-        self.reactor = reactor
+class InsteonSerialPLM(InsteonBasePLM):
+    def __init__(self, reactor, devicename, grammar = False, coalesce = False, pacing = False, max_rate = 8.0,
+                 capture = None, inventory = None, all_link_db = None, retry = None):
         self.devicename = devicename
 
-        super(InsteonSerialPLM, self).__init__(reactor)
+        super(InsteonSerialPLM, self).__init__(reactor, grammar, coalesce, pacing, max_rate, capture, inventory,
+                                               all_link_db, retry)
 
-        serialport.SerialPort(self.factory.protocol(),
+        serialport.SerialPort(self.factory.buildProtocol(None),
                               self.devicename,
                               self.reactor,
                               baudrate = 19200,
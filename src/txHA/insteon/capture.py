@@ -0,0 +1,227 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from twisted.internet import defer
+from twisted.internet import protocol
+
+import mmap
+import os
+import struct
+
+from .. import log
+
+# A capture file is MAGIC followed by records.  Each record is a little
+# endian double timestamp, a direction byte and a 16 bit length,
+# followed by the data exactly as it crossed the transport, so inbound
+# reads keep the chunking the decoder saw.  Files are only ever
+# appended to and can be read back through mmap.
+MAGIC = 'TXHACAP\x01'
+
+INBOUND = 0
+OUTBOUND = 1
+
+_record = struct.Struct('<dBH')
+_max_length = 0xffff
+
+class CaptureError(Exception):
+    pass
+
+class CaptureWriter(object):
+    """Append records to a capture file.  Timestamps come from clock
+    and never go backwards, even if the wall clock does.  Each record
+    is flushed as it is written, the last frames before a crash are
+    the ones a capture is for."""
+
+    def __init__(self, path, clock):
+        self.path = path
+        self.clock = clock
+        self.last = 0.0
+        self.file = open(path, 'ab')
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def record(self, direction, data):
+        timestamp = self.clock()
+        if timestamp < self.last:
+            timestamp = self.last
+        self.last = timestamp
+
+        for offset in range(0, len(data), _max_length):
+            chunk = data[offset:offset + _max_length]
+            self.file.write(_record.pack(timestamp, direction, len(chunk)))
+            self.file.write(chunk)
+        self.file.flush()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.flush()
+            self.file.close()
+
+class CaptureReader(object):
+    """Iterate over the records of a capture file as (timestamp,
+    direction, data) tuples.  A record cut short by a crash at the end
+    of the file is ignored."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        if os.fstat(self.file.fileno()).st_size < len(MAGIC):
+            self.file.close()
+            raise CaptureError('{} is not a capture file'.format(path))
+
+        self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise CaptureError('{} is not a capture file'.format(path))
+
+    def __iter__(self):
+        data = self.map
+        size = len(data)
+        offset = len(MAGIC)
+        while offset + _record.size <= size:
+            timestamp, direction, length = _record.unpack_from(data, offset)
+            offset += _record.size
+            if offset + length > size:
+                log.warning('truncated record at the end of {}', self.path)
+                return
+            yield timestamp, direction, data[offset:offset + length]
+            offset += length
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+class _CaptureTransport(object):
+    def __init__(self, transport, capture):
+        self._transport = transport
+        self._capture = capture
+
+    def write(self, data):
+        self._capture.record(OUTBOUND, data)
+        self._transport.write(data)
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
+
+class CaptureProtocol(protocol.Protocol):
+    """Wrap a protocol and record everything it reads and writes."""
+
+    def __init__(self, capture, wrapped):
+        self.capture = capture
+        self.wrapped = wrapped
+
+    def makeConnection(self, transport):
+        self.connected = 1
+        self.transport = transport
+        self.wrapped.makeConnection(_CaptureTransport(transport, self.capture))
+
+    def dataReceived(self, data):
+        self.capture.record(INBOUND, data)
+        self.wrapped.dataReceived(data)
+
+    def connectionLost(self, reason):
+        self.connected = 0
+        self.capture.close()
+        self.wrapped.connectionLost(reason)
+
+class Replayer(object):
+    """Feed the inbound records of a capture into a connected protocol.
+
+    With speed 1.0 the records are delivered with their original
+    spacing, 2.0 replays twice as fast and None delivers everything in
+    one go without involving the reactor.  Outbound records are
+    skipped, the protocol produces its own writes."""
+
+    def __init__(self, reactor, records, protocol, speed = 1.0):
+        if speed is not None and speed <= 0:
+            raise ValueError('speed must be positive')
+
+        self.reactor = reactor
+        self.records = iter(records)
+        self.protocol = protocol
+        self.speed = speed
+        self.count = 0
+        self.size = 0
+        self.started = None
+        self.first = None
+        self.deferred = None
+        self.delayed_call = None
+
+    def start(self):
+        """Returns a Deferred that fires with the number of records
+        fed once the capture has been replayed."""
+
+        self.deferred = defer.Deferred(canceller = self._cancel)
+        self.started = self.reactor.seconds()
+        self._next()
+        return self.deferred
+
+    def _cancel(self, d):
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+
+    def _feed(self, data):
+        self.count += 1
+        self.size += len(data)
+        self.protocol.dataReceived(data)
+
+    def _deliver(self, data):
+        self.delayed_call = None
+        self._feed(data)
+        self._next()
+
+    def _next(self):
+        for timestamp, direction, data in self.records:
+            if direction != INBOUND:
+                continue
+
+            if self.speed is None:
+                self._feed(data)
+                continue
+
+            if self.first is None:
+                self.first = timestamp
+
+            delay = self.started + (timestamp - self.first) / self.speed - self.reactor.seconds()
+            if delay > 0:
+                self.delayed_call = self.reactor.callLater(delay, self._deliver, data)
+                return
+
+            self._feed(data)
+
+        self.deferred.callback(self.count)
+
+def replay(reactor, path, protocol, speed = 1.0):
+    reader = CaptureReader(path)
+    d = Replayer(reactor, reader, protocol, speed).start()
+
+    def close(result):
+        reader.close()
+        return result
+
+    d.addBoth(close)
+    return d
@@ -0,0 +1,225 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from twisted.internet import defer
+
+import struct
+
+from .. import log
+from .inventory import writeAtomically
+
+# A database file is MAGIC, a version byte, the number of records and
+# of database deltas, then the records and the deltas.
+MAGIC = 'TXHAALDB'
+VERSION = 1
+
+_header = struct.Struct('!BII')
+_record = struct.Struct('!BB3s3s')
+_delta = struct.Struct('!3sB')
+
+class AllLinkRecord(object):
+    """One entry of the PLM's ALL-Link database."""
+
+    __slots__ = ('flags', 'group', 'address', 'link_data')
+
+    def __init__(self, flags, group, address, link_data):
+        self.flags = flags
+        self.group = group
+        self.address = address
+        self.link_data = link_data
+
+    @property
+    def in_use(self):
+        return bool(self.flags & 0x80)
+
+    @property
+    def controller(self):
+        """True if the PLM controls the group, False if it responds
+        to the device."""
+
+        return bool(self.flags & 0x40)
+
+    def __repr__(self):
+        return 'AllLinkRecord(0x{:02X}, {:d}, {!r}, {!r})'.format(self.flags, self.group, self.address, self.link_data)
+
+class AllLinkDatabase(object):
+    """The PLM's ALL-Link database, indexed by group and by linked
+    address.
+
+    The database is read from the PLM with a 0x69/0x6A walk into a
+    fresh table which replaces the current one when the walk ends, so
+    lookups keep answering from the previous copy meanwhile.  It is
+    marked out of date when the PLM links or unlinks something and
+    when a device reports a different database delta in its 0x19
+    status ACK than last time, and only then walked again."""
+
+    def __init__(self, path = None):
+        self.path = path
+        self.records = []
+        self.by_group = {}
+        self.by_address = {}
+        self.complete = False
+
+        # database delta last reported by each device, keyed by binary
+        # address
+        self.deltas = {}
+
+        # records collected by the walk in progress, and whether the
+        # database changed while it was running
+        self.walk = None
+        self.dirty = False
+        self.waiting = []
+
+    def _index(self, records):
+        self.records = records
+        self.by_group = {}
+        self.by_address = {}
+        for record in records:
+            if not record.in_use:
+                continue
+            self.by_group.setdefault(record.group, []).append(record)
+            self.by_address.setdefault(record.address, []).append(record)
+
+    def group(self, group):
+        """Addresses of the devices linked to the PLM in group."""
+
+        return [record.address for record in self.by_group.get(group, ())]
+
+    def responders(self, group):
+        """Addresses of the devices that respond when the PLM sends
+        to group."""
+
+        return [record.address for record in self.by_group.get(group, ()) if record.controller]
+
+    def groups(self):
+        return self.by_group.keys()
+
+    def links(self, address):
+        return list(self.by_address.get(address, ()))
+
+    def invalidate(self, reason):
+        log.debug('ALL-Link database out of date: {}', reason)
+        self.complete = False
+        if self.walk is not None:
+            self.dirty = True
+
+    def noteDelta(self, address, delta):
+        """Remember the database delta from a device's status ACK.
+        Returns True if it changed since we last saw it."""
+
+        previous = self.deltas.get(address.binary)
+        self.deltas[address.binary] = delta
+        return previous is not None and previous != delta
+
+    def wait(self):
+        """Returns a Deferred that fires with the database once it is
+        complete."""
+
+        if self.complete:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    def startWalk(self):
+        self.walk = []
+        self.dirty = False
+
+    def walked(self, record):
+        if self.walk is not None:
+            self.walk.append(record)
+
+    def finishWalk(self):
+        """Returns False if the database has to be walked again
+        because it changed during the walk."""
+
+        if self.walk is None:
+            return self.complete
+
+        self._index(self.walk)
+        self.walk = None
+        if self.dirty:
+            return False
+
+        self.complete = True
+        log.informational('ALL-Link database has {:d} records', len(self.records))
+        self.save()
+
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(self)
+        return True
+
+    def failWalk(self, reason):
+        self.walk = None
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.errback(reason)
+
+    def load(self):
+        if self.path is None:
+            return
+
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return
+
+        offset = len(MAGIC) + _header.size
+        if data[:len(MAGIC)] != MAGIC or len(data) < offset:
+            log.warning('{} is not an ALL-Link database, ignoring it', self.path)
+            return
+
+        version, records, deltas = _header.unpack_from(data, len(MAGIC))
+        if version != VERSION:
+            log.warning('{} has ALL-Link database version {}, expected {}, ignoring it', self.path, version, VERSION)
+            return
+
+        if len(data) != offset + records * _record.size + deltas * _delta.size:
+            log.warning('{} is truncated, ignoring it', self.path)
+            return
+
+        # imported here, the package imports this module
+        from . import InsteonAddress
+
+        loaded = []
+        for i in range(records):
+            flags, group, address, link_data = _record.unpack_from(data, offset)
+            loaded.append(AllLinkRecord(flags, group, InsteonAddress.from_bytes(address), link_data))
+            offset += _record.size
+
+        for i in range(deltas):
+            address, delta = _delta.unpack_from(data, offset)
+            self.deltas[address] = delta
+            offset += _delta.size
+
+        self._index(loaded)
+        self.complete = True
+
+    def save(self):
+        if self.path is None:
+            return
+
+        parts = [MAGIC, _header.pack(VERSION, len(self.records), len(self.deltas))]
+        for record in self.records:
+            parts.append(_record.pack(record.flags, record.group, record.address.binary, record.link_data))
+        for address, delta in sorted(self.deltas.items()):
+            parts.append(_delta.pack(address, delta))
+        writeAtomically(self.path, ''.join(parts))
@@ -0,0 +1,351 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from twisted.internet import protocol
+from twisted.python import failure
+
+import collections
+import struct
+
+from .. import log
+
+ACK = '\x06'
+NAK = '\x15'
+
+_standard_message_received = struct.Struct('!2x3s3scBB')
+_extended_message_received = struct.Struct('!2x3s3scBB14s')
+_x10_received = struct.Struct('!2xBB')
+_all_linking_completed = struct.Struct('!2xBB3sBBB')
+_button_event_report = struct.Struct('!2xB')
+_all_link_cleanup_failure_report = struct.Struct('!3xB3s')
+_all_link_record_response = struct.Struct('!2xBB3s3s')
+_im_info = struct.Struct('!2x3sBBBc')
+_send_all_link_command_echo = struct.Struct('!2xBBBc')
+_standard_message_echo = struct.Struct('!2x3scBBc')
+_extended_message_echo = struct.Struct('!2x3scBB14sc')
+_send_x10_echo = struct.Struct('!2xBBc')
+_start_all_linking_echo = struct.Struct('!2xBBc')
+_set_host_device_category_echo = struct.Struct('!2xBBBc')
+_set_im_configuration_echo = struct.Struct('!2xBc')
+_manage_all_link_record_echo = struct.Struct('!2xBBB3s3sc')
+_rf_sleep_echo = struct.Struct('!2xBBc')
+_get_im_configuration_echo = struct.Struct('!2xB2xc')
+_acknak_echo = struct.Struct('!2xc')
+
+class InsteonFrameError(ValueError):
+    pass
+
+class InsteonFrameDecoder(object):
+    """Incremental, table driven decoder for the PLM serial protocol.
+
+    Every frame starts with 0x02 followed by a command byte that
+    determines the length of the frame.  Bytes are buffered until a
+    complete frame is available and then unpacked with a precompiled
+    struct and dispatched to the same receiver methods that the
+    parsley grammar calls."""
+
+    # command byte -> (frame length, decode method)
+    frames = {0x50: (11, '_standardMessageReceived'),
+              0x51: (25, '_extendedMessageReceived'),
+              0x52: (4,  '_x10Received'),
+              0x53: (10, '_allLinkingCompleted'),
+              0x54: (3,  '_buttonEventReport'),
+              0x55: (2,  '_userResetDetected'),
+              0x56: (7,  '_allLinkCleanupFailureReport'),
+              0x57: (10, '_allLinkRecordResponse'),
+              0x58: (3,  '_allLinkCleanupStatusReport'),
+              0x60: (9,  '_imInfo'),
+              0x61: (6,  '_sendAllLinkCommandEcho'),
+              0x62: (None, '_messageEcho'),
+              0x63: (5,  '_sendX10Echo'),
+              0x64: (5,  '_startAllLinkingEcho'),
+              0x65: (3,  '_cancelAllLinkingEcho'),
+              0x66: (6,  '_setHostDeviceCategoryEcho'),
+              0x67: (3,  '_resetTheIMEcho'),
+              0x69: (3,  '_allLinkRecordEcho'),
+              0x6a: (3,  '_allLinkRecordEcho'),
+              0x6b: (4,  '_setIMConfigurationEcho'),
+              0x6c: (3,  '_getAllLinkRecordForSenderEcho'),
+              0x6d: (3,  '_ledOnEcho'),
+              0x6e: (3,  '_ledOffEcho'),
+              0x6f: (12, '_manageAllLinkRecordEcho'),
+              0x72: (5,  '_rfSleepEcho'),
+              0x73: (6,  '_getIMConfigurationEcho')}
+
+    # frames the PLM sends on its own, which end without an ACK/NAK
+    # byte that would show they weren't cut short
+    unterminated = (0x50, 0x51, 0x52, 0x53, 0x54, 0x55, 0x56, 0x57)
+
+    def __init__(self, receiver, bindings):
+        self.receiver = receiver
+        self.address = bindings['InsteonAddress'].from_bytes
+        self.flags = bindings['InsteonMessageFlags'].from_bytes
+        self.buffer = b''
+        self.table = {}
+        for command, (length, name) in self.frames.items():
+            self.table[chr(command)] = (length, getattr(self, name))
+        self.unterminated = frozenset(chr(command) for command in self.unterminated)
+
+        # bytes thrown away while hunting for the start of a frame and
+        # the number of times that happened
+        self.discarded = 0
+        self.resyncs = 0
+
+        # frames decoded, keyed by command byte
+        self.received = collections.defaultdict(int)
+
+    def feed(self, data):
+        """Decode as many complete frames as possible from data.
+
+        Anything that can't be the start of a known frame (and frames
+        whose trailing ACK/NAK byte is wrong, which usually means a
+        truncated frame) is skipped up to the next 0x02.  Frames
+        without an ACK/NAK byte must be followed by 0x02 or the end of
+        the data, if they aren't and contain the start of a known
+        frame decoding resumes there instead.  At most one
+        partial frame is kept between calls so the buffer never grows
+        beyond the longest frame."""
+
+        buf = self.buffer + data
+        end = len(buf)
+        offset = 0
+
+        while offset < end:
+            if buf[offset] != '\x02':
+                offset = self._resync(buf, offset)
+                continue
+
+            if end - offset < 2:
+                break
+
+            if buf[offset + 1] not in self.table:
+                offset = self._resync(buf, offset)
+                continue
+
+            command = buf[offset + 1]
+            length, decode = self.table[command]
+
+            if length is None:
+                # 0x62 echoes carry 14 bytes of user data when the
+                # extended bit is set in the message flags
+                if end - offset < 6:
+                    break
+                if ord(buf[offset + 5]) & 0x10:
+                    length = 23
+                else:
+                    length = 9
+
+            if end - offset < length:
+                break
+
+            if command in self.unterminated and offset + length < end and buf[offset + length] != '\x02':
+                offset = self._resyncInside(buf, offset, length)
+                continue
+
+            try:
+                decode(buf, offset, length)
+
+            except InsteonFrameError:
+                offset = self._resync(buf, offset)
+                continue
+
+            except Exception:
+                # a bug in a receiver shouldn't take the whole
+                # connection down with it
+                log.err()
+
+            self.received[command] += 1
+            offset += length
+
+        self.buffer = buf[offset:]
+
+    def _resync(self, buf, offset):
+        start = buf.find('\x02', offset + 1)
+        if start < 0:
+            start = len(buf)
+        self.discarded += start - offset
+        self.resyncs += 1
+        log.warning('discarded {:d} bytes while resynchronizing: {!r}', start - offset, buf[offset:start])
+        return start
+
+    def _resyncInside(self, buf, offset, length):
+        # the frame was probably cut short by the next one, look for
+        # where that starts
+        start = buf.find('\x02', offset + 1, offset + length)
+        while start >= 0:
+            if start + 1 < len(buf) and buf[start + 1] in self.table:
+                self.discarded += start - offset
+                self.resyncs += 1
+                log.warning('discarded {:d} bytes of a truncated frame: {!r}', start - offset, buf[offset:start])
+                return start
+            start = buf.find('\x02', start + 1, offset + length)
+        return self._resync(buf, offset)
+
+    def _acknak(self, value):
+        if value == ACK:
+            return True
+        if value == NAK:
+            return False
+        raise InsteonFrameError('expected ACK or NAK, got 0x{:02x}'.format(ord(value)))
+
+    def _standardMessageReceived(self, buf, offset, length):
+        address_from, address_to, flags, command_1, command_2 = _standard_message_received.unpack_from(buf, offset)
+        self.receiver.receiveMessage(self.address(address_from), self.address(address_to), self.flags(flags),
+                                     command_1, command_2)
+
+    def _extendedMessageReceived(self, buf, offset, length):
+        address_from, address_to, flags, command_1, command_2, user_data = _extended_message_received.unpack_from(buf, offset)
+        self.receiver.receiveMessage(self.address(address_from), self.address(address_to), self.flags(flags),
+                                     command_1, command_2, user_data)
+
+    def _x10Received(self, buf, offset, length):
+        rawx10, x10flag = _x10_received.unpack_from(buf, offset)
+        self.receiver.receive('x10_received', rawx10, x10flag)
+
+    def _allLinkingCompleted(self, buf, offset, length):
+        link_code, all_link_group, linked, category, subcategory, version = _all_linking_completed.unpack_from(buf, offset)
+        self.receiver.receive('all_linking_completed', link_code, all_link_group, self.address(linked),
+                              category, subcategory, version)
+
+    def _buttonEventReport(self, buf, offset, length):
+        button_event, = _button_event_report.unpack_from(buf, offset)
+        self.receiver.receive('button_event_report', button_event)
+
+    def _userResetDetected(self, buf, offset, length):
+        self.receiver.receive('user_reset_detected')
+
+    def _allLinkCleanupFailureReport(self, buf, offset, length):
+        all_link_group, address = _all_link_cleanup_failure_report.unpack_from(buf, offset)
+        self.receiver.receiveAllLinkCleanupFailureReport(all_link_group, self.address(address))
+
+    def _allLinkRecordResponse(self, buf, offset, length):
+        all_link_record_flags, all_link_group, address, link_data = _all_link_record_response.unpack_from(buf, offset)
+        self.receiver.receiveAllLinkRecord(all_link_record_flags, all_link_group, self.address(address), link_data)
+
+    def _allLinkCleanupStatusReport(self, buf, offset, length):
+        acknak, = _acknak_echo.unpack_from(buf, offset)
+        self.receiver.receiveAllLinkCleanupStatusReport(self._acknak(acknak))
+
+    def _imInfo(self, buf, offset, length):
+        address, category, subcategory, version, acknak = _im_info.unpack_from(buf, offset)
+        self.receiver.receiveIMInfo(self.address(address), category, subcategory, version, self._acknak(acknak))
+
+    def _sendAllLinkCommandEcho(self, buf, offset, length):
+        all_link_group, all_link_command, broadcast_command_2, acknak = _send_all_link_command_echo.unpack_from(buf, offset)
+        self.receiver.receiveAllLinkCommandEcho(all_link_group, all_link_command, broadcast_command_2,
+                                                self._acknak(acknak))
+
+    def _messageEcho(self, buf, offset, length):
+        if length == 9:
+            address, flags, command_1, command_2, acknak = _standard_message_echo.unpack_from(buf, offset)
+            self.receiver.receiveMessageEcho(self.address(address), self.flags(flags), command_1, command_2,
+                                             self._acknak(acknak))
+
+        else:
+            address, flags, command_1, command_2, user_data, acknak = _extended_message_echo.unpack_from(buf, offset)
+            self.receiver.receiveMessageEcho(self.address(address), self.flags(flags), command_1, command_2,
+                                             self._acknak(acknak), user_data)
+
+    def _sendX10Echo(self, buf, offset, length):
+        rawx10, x10flag, acknak = _send_x10_echo.unpack_from(buf, offset)
+        self.receiver.receive('send_x10_echo', rawx10, x10flag, self._acknak(acknak))
+
+    def _startAllLinkingEcho(self, buf, offset, length):
+        link_code, all_link_group, acknak = _start_all_linking_echo.unpack_from(buf, offset)
+        self.receiver.receive('start_all_linking_echo', link_code, all_link_group, self._acknak(acknak))
+
+    def _cancelAllLinkingEcho(self, buf, offset, length):
+        acknak, = _acknak_echo.unpack_from(buf, offset)
+        self.receiver.receive('cancel_all_linking', self._acknak(acknak))
+
+    def _setHostDeviceCategoryEcho(self, buf, offset, length):
+        category, subcategory, version, acknak = _set_host_device_category_echo.unpack_from(buf, offset)
+        self.receiver.receive('set_host_device_category_echo', category, subcategory, version, self._acknak(acknak))
+
+    def _resetTheIMEcho(self, buf, offset, length):
+        acknak, = _acknak_echo.unpack_from(buf, offset)
+        self.receiver.receive('reset_the_im_echo', self._acknak(acknak))
+
+    def _allLinkRecordEcho(self, buf, offset, length):
+        acknak, = _acknak_echo.unpack_from(buf, offset)
+        self.receiver.receiveAllLinkRecordEcho(self._acknak(acknak))
+
+    def _setIMConfigurationEcho(self, buf, offset, length):
+        flags, acknak = _set_im_configuration_echo.unpack_from(buf, offset)
+        self.receiver.receive('set_im_configuration_echo', flags, self._acknak(acknak))
+
+    def _getAllLinkRecordForSenderEcho(self, buf, offset, length):
+        acknak, = _acknak_echo.unpack_from(buf, offset)
+        self.receiver.receive('get_all_link_record_for_sender_echo', self._acknak(acknak))
+
+    def _ledOnEcho(self, buf, offset, length):
+        acknak, = _acknak_echo.unpack_from(buf, offset)
+        self.receiver.receive('led_on_echo', self._acknak(acknak))
+
+    def _ledOffEcho(self, buf, offset, length):
+        acknak, = _acknak_echo.unpack_from(buf, offset)
+        self.receiver.receive('led_off_echo', self._acknak(acknak))
+
+    def _manageAllLinkRecordEcho(self, buf, offset, length):
+        control_code, all_link_record_flags, all_link_group, linked, link_data, acknak = _manage_all_link_record_echo.unpack_from(buf, offset)
+        self.receiver.receive('manage_all_link_record_echo', control_code, all_link_record_flags, all_link_group,
+                              self.address(linked), link_data, self._acknak(acknak))
+
+    def _rfSleepEcho(self, buf, offset, length):
+        command_1_data, command_2_data, acknak = _rf_sleep_echo.unpack_from(buf, offset)
+        self.receiver.receive('rf_sleep_echo', command_1_data, command_2_data, self._acknak(acknak))
+
+    def _getIMConfigurationEcho(self, buf, offset, length):
+        flags, acknak = _get_im_configuration_echo.unpack_from(buf, offset)
+        self.receiver.receive('get_im_configuration_echo', flags, self._acknak(acknak))
+
+class InsteonDecoderProtocol(protocol.Protocol):
+    """Drop-in replacement for parsley's ParserProtocol that feeds
+    received data through an InsteonFrameDecoder."""
+
+    def __init__(self, senderFactory, receiverFactory, bindings):
+        self._senderFactory = senderFactory
+        self._receiverFactory = receiverFactory
+        self._bindings = dict(bindings)
+        self._disconnecting = False
+
+    def connectionMade(self):
+        self.sender = self._senderFactory(self.transport)
+        self.receiver = self._receiverFactory(self.sender)
+        # prepareParsing() fires plm.ready, the decoder has to exist by
+        # then
+        self.decoder = InsteonFrameDecoder(self.receiver, self._bindings)
+        self.receiver.prepareParsing(self)
+
+    def dataReceived(self, data):
+        if self._disconnecting:
+            return
+
+        try:
+            self.decoder.feed(data)
+        except Exception:
+            self.connectionLost(failure.Failure())
+            self.transport.abortConnection()
+            return
+
+    def connectionLost(self, reason):
+        if self._disconnecting:
+            return
+        self.receiver.finishParsing(reason)
+        self._disconnecting = True
@@ -0,0 +1,198 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import itertools
+
+from .. import log
+from .flags import InsteonMessageFlags
+
+class InsteonEvent(object):
+    """A message a device sent, as handed to subscribers.  address is
+    the sender, group is None except for group messages."""
+
+    __slots__ = ('address', 'address_to', 'flags', 'command_1', 'command_2', 'user_data', 'group', 'timestamp')
+
+    message_type = None
+
+    def __init__(self, address, address_to, flags, command_1, command_2, user_data, group, timestamp):
+        self.address = address
+        self.address_to = address_to
+        self.flags = flags
+        self.command_1 = command_1
+        self.command_2 = command_2
+        self.user_data = user_data
+        self.group = group
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return '{}({!r}, 0x{:02X}, 0x{:02X}, group = {!r})'.format(self.__class__.__name__, self.address,
+                                                                   self.command_1, self.command_2, self.group)
+
+class BroadcastEvent(InsteonEvent):
+    """A broadcast such as the set button announcement, which carries
+    the device's category, subcategory and firmware in the to address."""
+
+    __slots__ = ()
+    message_type = InsteonMessageFlags.BROADCAST
+
+    @property
+    def category(self):
+        return self.address_to.high
+
+    @property
+    def subcategory(self):
+        return self.address_to.middle
+
+    @property
+    def firmware(self):
+        return self.address_to.low
+
+class DirectEvent(InsteonEvent):
+    __slots__ = ()
+    message_type = InsteonMessageFlags.DIRECT
+
+class DirectAckEvent(InsteonEvent):
+    __slots__ = ()
+    message_type = InsteonMessageFlags.DIRECT_ACK
+
+class DirectNakEvent(InsteonEvent):
+    __slots__ = ()
+    message_type = InsteonMessageFlags.DIRECT_NAK
+
+class GroupBroadcastEvent(InsteonEvent):
+    """A device controlling group, for example a switch being turned
+    on by hand."""
+
+    __slots__ = ()
+    message_type = InsteonMessageFlags.GROUP_BROADCAST
+
+class GroupCleanupEvent(InsteonEvent):
+    __slots__ = ()
+    message_type = InsteonMessageFlags.GROUP_CLEANUP
+
+class GroupCleanupAckEvent(InsteonEvent):
+    """A responder acknowledging the PLM's cleanup of group."""
+
+    __slots__ = ()
+    message_type = InsteonMessageFlags.GROUP_CLEANUP_ACK
+
+class GroupCleanupNakEvent(InsteonEvent):
+    __slots__ = ()
+    message_type = InsteonMessageFlags.GROUP_CLEANUP_NAK
+
+_event_types = {}
+for _event_type in (BroadcastEvent, DirectEvent, DirectAckEvent, DirectNakEvent, GroupBroadcastEvent,
+                    GroupCleanupEvent, GroupCleanupAckEvent, GroupCleanupNakEvent):
+    _event_types[_event_type.message_type] = _event_type
+del _event_type
+
+class Subscription(object):
+    __slots__ = ('registry', 'key', 'callback', 'sequence')
+
+    def __init__(self, registry, key, callback, sequence):
+        self.registry = registry
+        self.key = key
+        self.callback = callback
+        self.sequence = sequence
+
+    @property
+    def active(self):
+        return self.registry is not None
+
+    def cancel(self):
+        if self.registry is not None:
+            self.registry._remove(self)
+            self.registry = None
+
+class EventRegistry(object):
+    """Callbacks for the messages devices send, selected by sender
+    address, group, command 1 and message type, any of which may be
+    left out to match everything.
+
+    Subscriptions are filed under the tuple of the four and a message
+    looks up the tuples it could match with the left out fields set
+    to None, 8 or for group messages 16 dict lookups however many
+    subscriptions there are.  Subscribers are called in the order they
+    subscribed."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.subscriptions = {}
+        self.sequence = itertools.count()
+        self.count = 0
+
+    def subscribe(self, callback, address = None, group = None, command_1 = None, message_type = None):
+        """Call callback with an InsteonEvent for every matching
+        message.  Returns a Subscription, cancel() it to stop."""
+
+        key = (address, group, command_1, message_type)
+        subscription = Subscription(self, key, callback, next(self.sequence))
+        self.subscriptions.setdefault(key, []).append(subscription)
+        self.count += 1
+        return subscription
+
+    def _remove(self, subscription):
+        subscriptions = self.subscriptions[subscription.key]
+        subscriptions.remove(subscription)
+        if not subscriptions:
+            del self.subscriptions[subscription.key]
+        self.count -= 1
+
+    def matching(self, address, group, command_1, message_type):
+        get = self.subscriptions.get
+        groups = (None,) if group is None else (group, None)
+        matched = []
+        for a in (address, None):
+            for g in groups:
+                for c in (command_1, None):
+                    for m in (message_type, None):
+                        subscriptions = get((a, g, c, m))
+                        if subscriptions:
+                            matched.extend(subscriptions)
+        return matched
+
+    def dispatch(self, address, address_to, flags, command_1, command_2, user_data = None):
+        if not self.count:
+            return
+
+        message_type = flags.message_type
+        if message_type == InsteonMessageFlags.GROUP_BROADCAST:
+            group = address_to.low
+        elif message_type in (InsteonMessageFlags.GROUP_CLEANUP, InsteonMessageFlags.GROUP_CLEANUP_ACK,
+                              InsteonMessageFlags.GROUP_CLEANUP_NAK):
+            group = command_2
+        else:
+            group = None
+
+        matched = self.matching(address, group, command_1, message_type)
+        if not matched:
+            return
+        if len(matched) > 1:
+            matched.sort(key = lambda subscription: subscription.sequence)
+
+        event = _event_types[message_type](address, address_to, flags, command_1, command_2, user_data, group,
+                                           self.clock.seconds())
+        for subscription in matched:
+            # a subscriber cancelled by an earlier one isn't called
+            if subscription.registry is None:
+                continue
+            try:
+                subscription.callback(event)
+            except Exception:
+                log.err(None, 'event subscriber {!r} failed'.format(subscription.callback))
@@ -0,0 +1,109 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+class InsteonMessageFlags(object):
+    """Immutable, decoded Insteon message flags.
+
+    There are only 256 possible flag bytes so every one of them is
+    decoded once into a shared table and InsteonMessageFlags(value)
+    just hands back the table entry.  Use replace() to get the flags
+    with some of the fields changed."""
+
+    __slots__ = ('value', 'binary', 'message_type', 'extended', 'hops_left', 'max_hops')
+
+    BROADCAST = 4
+    DIRECT = 0
+    DIRECT_ACK = 1
+    DIRECT_NAK = 5
+    GROUP_BROADCAST = 6
+    GROUP_CLEANUP = 2
+    GROUP_CLEANUP_ACK = 3
+    GROUP_CLEANUP_NAK = 7
+
+    _table = []
+    _by_binary = {}
+
+    def __new__(klass, flags = 0):
+        if isinstance(flags, basestring):
+            if len(flags) != 1:
+                raise ValueError('flags must be a single byte string')
+            return klass._by_binary[flags]
+        if not isinstance(flags, (int, long)) or not 0 <= flags <= 0xff:
+            raise ValueError('flags must be in the range [0, 255]')
+        return klass._table[flags]
+
+    @classmethod
+    def from_bytes(klass, binary):
+        return klass._by_binary[binary]
+
+    @classmethod
+    def _build(klass, value):
+        flags = object.__new__(klass)
+        for name, field in (('value', value),
+                            ('binary', chr(value)),
+                            ('message_type', value >> 5),
+                            ('extended', (value & 0x10) != 0),
+                            ('hops_left', (value >> 2) & 0x03),
+                            ('max_hops', value & 0x03)):
+            object.__setattr__(flags, name, field)
+        return flags
+
+    def __setattr__(self, name, value):
+        raise AttributeError('InsteonMessageFlags is immutable')
+
+    def __reduce__(self):
+        return (InsteonMessageFlags, (self.value,))
+
+    def replace(self, message_type = None, extended = None, hops_left = None, max_hops = None):
+        value = self.value
+        if message_type is not None:
+            value = (value & 0x1f) | ((message_type & 0x07) << 5)
+        if extended is not None:
+            value = (value & ~0x10) | (0x10 if extended else 0x00)
+        if hops_left is not None:
+            value = (value & ~0x0c) | ((hops_left & 0x03) << 2)
+        if max_hops is not None:
+            value = (value & ~0x03) | (max_hops & 0x03)
+        return self._table[value]
+
+    def __getitem__(self, index):
+        return (self.value >> index) & 1
+
+    def __getslice__(self, start, end):
+        return (self.value >> start) & ((1 << (end - start)) - 1)
+
+    def __int__(self):
+        return self.value
+
+    def __hash__(self):
+        return self.value
+
+    def __eq__(self, other):
+        return self is other or (isinstance(other, InsteonMessageFlags) and self.value == other.value)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return 'InsteonMessageFlags(0x{:02X})'.format(self.value)
+
+for value in range(256):
+    InsteonMessageFlags._table.append(InsteonMessageFlags._build(value))
+    InsteonMessageFlags._by_binary[chr(value)] = InsteonMessageFlags._table[value]
+del value
@@ -0,0 +1,97 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import os
+import struct
+import tempfile
+
+from .. import log
+
+# An inventory file is MAGIC, a version byte and then one fixed size
+# record per device: address, category, subcategory, firmware, the
+# time the identity was last confirmed by the device itself and, since
+# version 2, how many hops away the device is (0xff if unknown).
+MAGIC = 'TXHAINV'
+VERSION = 2
+
+_records = {1: struct.Struct('!3sBBBd'),
+            2: struct.Struct('!3sBBBdB')}
+_record = _records[VERSION]
+
+_unknown_hops = 0xff
+
+def writeAtomically(path, data):
+    """Replace the file at path with data, so that a crash leaves
+    either the old or the new contents behind."""
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(dir = directory, prefix = '.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary, path)
+
+    except Exception:
+        os.unlink(temporary)
+        raise
+
+class DeviceInventory(object):
+    """What we know about each device, kept on disk between runs."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """Return a dict of binary address -> (category, subcategory,
+        firmware, verified, hops).  A missing, foreign or newer file gives
+        an empty inventory rather than an error, it is only a cache."""
+
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return {}
+
+        header = len(MAGIC) + 1
+        if data[:len(MAGIC)] != MAGIC or len(data) < header:
+            log.warning('{} is not a device inventory, ignoring it', self.path)
+            return {}
+
+        version = ord(data[len(MAGIC)])
+        record = _records.get(version)
+        if record is None:
+            log.warning('{} has inventory version {}, expected {}, ignoring it', self.path, version, VERSION)
+            return {}
+
+        entries = {}
+        for offset in range(header, len(data) - record.size + 1, record.size):
+            fields = record.unpack_from(data, offset)
+            hops = fields[5] if len(fields) > 5 else _unknown_hops
+            entries[fields[0]] = fields[1:5] + (None if hops == _unknown_hops else hops,)
+        return entries
+
+    def save(self, entries):
+        records = [MAGIC, chr(VERSION)]
+        for address, (category, subcategory, firmware, verified, hops) in sorted(entries.items()):
+            if hops is None:
+                hops = _unknown_hops
+            records.append(_record.pack(address, category, subcategory, firmware, verified, hops))
+        writeAtomically(self.path, ''.join(records))
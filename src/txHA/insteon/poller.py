@@ -0,0 +1,224 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from ..tbq import BACKGROUND
+from .. import log
+
+class _PollTarget(object):
+    def __init__(self, address, freshness):
+        self.address = address
+        self.freshness = freshness
+        self.polling = False
+        self.missed = False
+        self.failures = 0
+        self.retry_at = None
+        self.last_poll = None
+        self.sent_age = None
+        self.polls = 0
+        self.misses = 0
+        self.skipped = 0
+        self.late = 0
+        self.max_age = 0.0
+
+class StatusPoller(object):
+    """Keep the levels of a set of devices no older than a freshness
+    target per device, with as few status requests as possible.
+
+    Polls are spaced evenly at share of the PLM's current send rate,
+    sent at BACKGROUND priority, and always go to the device furthest
+    past its target, devices whose last poll failed first once their
+    retry delay, doubling with every failure in a row, has passed.
+    Devices parked by their circuit breaker are left alone.  A device
+    whose level was refreshed by its own broadcasts or by commands we
+    sent isn't polled at all until it goes stale again."""
+
+    # fraction of the send rate that polling may use
+    share = 0.5
+
+    # never wait longer than this between looking for stale devices,
+    # so new targets and a changed send rate are picked up
+    max_sleep = 10.0
+
+    # seconds before a device whose poll failed is polled again, twice
+    # as long after each further failure up to max_retry_delay
+    retry_delay = 5.0
+    max_retry_delay = 300.0
+
+    def __init__(self, plm, priority = BACKGROUND):
+        self.plm = plm
+        self.reactor = plm.reactor
+        self.priority = priority
+        self.targets = {}
+        self.delayed_call = None
+        self.running = False
+
+    def add(self, address, freshness):
+        """Keep the level of address no older than freshness
+        seconds."""
+
+        target = self.targets.get(address)
+        if target is None:
+            self.targets[address] = _PollTarget(address, float(freshness))
+        else:
+            target.freshness = float(freshness)
+        self._reschedule()
+
+    def remove(self, address):
+        self.targets.pop(address, None)
+
+    def start(self):
+        self.running = True
+        self._reschedule()
+
+    def stop(self):
+        self.running = False
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+
+    def _reschedule(self):
+        if not self.running:
+            return
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = self.reactor.callLater(0, self._tick)
+
+    def _rate(self):
+        if self.plm.protocol is None:
+            return 1.0
+        return self.plm.protocol.tbq.token_rate * self.share
+
+    def _age(self, address, now):
+        device = self.plm.devices.get(address)
+        if device is None or device.state_updated is None:
+            return None
+        return now - device.state_updated
+
+    def _tick(self):
+        self.delayed_call = None
+        if not self.running:
+            return
+
+        if self.plm.protocol is None:
+            # not connected (yet), nothing can be sent
+            self.delayed_call = self.reactor.callLater(self.max_sleep, self._tick)
+            return
+
+        # poll one interval early so the answer is back before the
+        # target runs out
+        now = self.reactor.seconds()
+        interval = 1.0 / self._rate()
+        best = None
+        best_key = None
+        sleep = self.max_sleep
+        for target in self.targets.values():
+            if target.polling:
+                continue
+
+            device = self.plm.devices.get(target.address)
+            if device is not None and device.breaker.open:
+                continue
+
+            if target.retry_at is not None and now < target.retry_at:
+                sleep = min(sleep, target.retry_at - now)
+                continue
+
+            due = target.freshness - interval
+            age = self._age(target.address, now)
+            if age is not None and age < due:
+                if target.last_poll is not None and now - target.last_poll >= due:
+                    # a poll would have been due, traffic saved it
+                    target.skipped += 1
+                    target.last_poll = now
+                sleep = min(sleep, due - age)
+                continue
+
+            # failed devices whose retry time has come first, then the
+            # one furthest past its target, never seen counts as
+            # infinitely stale
+            overdue = float('inf') if age is None else age / target.freshness
+            key = (target.missed, overdue)
+            if best_key is None or key > best_key:
+                best = target
+                best_key = key
+
+        if best is None:
+            self.delayed_call = self.reactor.callLater(sleep, self._tick)
+            return
+
+        self._poll(best, now)
+        self.delayed_call = self.reactor.callLater(interval, self._tick)
+
+    def _poll(self, target, now):
+        target.polling = True
+        target.sent_age = self._age(target.address, now)
+        target.polls += 1
+        target.last_poll = now
+        d = self.plm.protocol.sendStatusRequest(target.address, priority = self.priority)
+        d.addCallbacks(self._polled, self._failed, callbackArgs = (target,), errbackArgs = (target,))
+
+    def _polled(self, status, target):
+        target.polling = False
+        target.missed = False
+        target.failures = 0
+        target.retry_at = None
+
+        # how old the level got before this answer replaced it
+        if target.sent_age is not None:
+            age = target.sent_age + self.reactor.seconds() - target.last_poll
+            target.max_age = max(target.max_age, age)
+            if age > target.freshness:
+                target.late += 1
+
+    def _failed(self, reason, target):
+        target.polling = False
+        target.missed = True
+        target.misses += 1
+        target.failures += 1
+        delay = min(self.max_retry_delay, self.retry_delay * 2 ** (target.failures - 1))
+        target.retry_at = self.reactor.seconds() + delay
+        log.debug('polling {!r} failed: {}', target.address, reason.getErrorMessage())
+
+    def report(self):
+        """How fresh the targets are compared to what was asked for.
+
+        required_rate is the number of polls per second needed if no
+        device ever refreshed itself, available_rate what polling may
+        use, if the first is larger the targets can't all be met."""
+
+        now = self.reactor.seconds()
+        devices = {}
+        fresh = 0
+        for address, target in self.targets.items():
+            age = self._age(address, now)
+            if age is not None and age <= target.freshness:
+                fresh += 1
+            devices[address] = {'freshness': target.freshness,
+                                'age': age,
+                                'polls': target.polls,
+                                'misses': target.misses,
+                                'skipped': target.skipped,
+                                'late': target.late,
+                                'max_age': target.max_age}
+
+        return {'devices': devices,
+                'fresh': fresh,
+                'stale': len(self.targets) - fresh,
+                'required_rate': sum(1.0 / target.freshness for target in self.targets.values()),
+                'available_rate': self._rate()}
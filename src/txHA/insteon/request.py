@@ -0,0 +1,196 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from twisted.internet import defer
+from twisted.python import failure
+
+class InsteonError(Exception):
+    pass
+
+class InsteonNAKError(InsteonError):
+    """The PLM or the device answered a request with a NAK."""
+
+class InsteonDeviceNAKError(InsteonNAKError):
+    """The device itself NAKed a request, asking again won't help."""
+
+class InsteonTimeoutError(InsteonError):
+    """No answer to a request arrived in time."""
+
+class InsteonUnreachableError(InsteonError):
+    """The device stopped answering, nothing is sent to it until it
+    answers a probe again."""
+
+class InsteonResponse(object):
+    """The direct ACK that a device sent in reply to a request."""
+
+    def __init__(self, address, flags, command_1, command_2, user_data = None):
+        self.address = address
+        self.flags = flags
+        self.command_1 = command_1
+        self.command_2 = command_2
+        self.user_data = user_data
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, 0x{:02X}, 0x{:02X}, {!r})'.format(self.__class__.__name__,
+                                                                   self.address, self.flags,
+                                                                   self.command_1, self.command_2,
+                                                                   self.user_data)
+
+class InsteonStatus(InsteonResponse):
+    """Reply to a 0x19 status request.  The device puts its ALL-Link
+    database delta in command 1 and its current level in command 2."""
+
+    @property
+    def database_delta(self):
+        return self.command_1
+
+    @property
+    def level(self):
+        return self.command_2
+
+    @property
+    def percent(self):
+        return int(round(self.command_2 / 255.0 * 100))
+
+class _InsteonRequest(object):
+    """One outstanding request in the protocol's correlation table.
+
+    A request is queued, written to the PLM, then matched against the
+    PLM's echo and, if a reply is expected, against the device's
+    direct ACK or NAK.  The timeout starts when the request is actually
+    written, not when it is queued."""
+
+    def __init__(self, protocol, key, message, timeout, response = None, priority = None):
+        self.protocol = protocol
+        self.key = key
+        self.message = message
+        self.timeout = timeout
+        self.response = response
+        self.priority = priority
+        self.sent = False
+        self.sent_at = None
+        self.echoed = False
+        self.finished = False
+        self.delayed_call = None
+        self.deferred = defer.Deferred(canceller = self._cancel)
+        self.followers = []
+
+    @property
+    def expects_reply(self):
+        return self.response is not None
+
+    def write(self, transport):
+        transport.write(self.message)
+        self.sent = True
+        self.sent_at = self.protocol.reactor.seconds()
+        self.delayed_call = self.protocol.reactor.callLater(self.timeout, self._timedOut)
+
+    def _remove(self):
+        self.finished = True
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+        self.protocol._removeRequest(self)
+
+    def follow(self):
+        """Return another Deferred that fires with the same result as
+        this request, used when requests are coalesced."""
+
+        d = defer.Deferred()
+        self.followers.append(d)
+        return d
+
+    def _fireFollowers(self, result):
+        followers, self.followers = self.followers, []
+        for d in followers:
+            if not d.called:
+                if isinstance(result, failure.Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+
+    def _cancel(self, d):
+        self._remove()
+        self._fireFollowers(failure.Failure(defer.CancelledError()))
+
+    def _timedOut(self):
+        self.delayed_call = None
+        self.protocol._requestTimedOut(self)
+        self.fail(InsteonTimeoutError('no reply to {!r}'.format(self.key)))
+
+    def finish(self, result):
+        self._remove()
+        self.deferred.callback(result)
+        self._fireFollowers(result)
+
+    def fail(self, reason):
+        if not isinstance(reason, failure.Failure):
+            reason = failure.Failure(reason)
+        self._remove()
+        self.deferred.errback(reason)
+        self._fireFollowers(reason)
+
+class _InsteonGroupCommand(object):
+    """A 0x61 group broadcast waiting for the cleanups that the PLM
+    sends to each member of the group on its own afterwards.
+
+    Members are counted as done when they ACK their cleanup.  The PLM
+    reports the members that never did with 0x56 and the end of the
+    cleanups with 0x58, if that doesn't arrive in time whatever hasn't
+    ACKed yet is treated as missed.  deferred fires with the set of
+    members that missed."""
+
+    def __init__(self, protocol, group, command_1, members, timeout):
+        self.protocol = protocol
+        self.group = group
+        self.command_1 = command_1
+        self.members = frozenset(members)
+        self.timeout = timeout
+        self.acked = set()
+        self.finished = False
+        self.delayed_call = None
+        self.deferred = defer.Deferred()
+
+    def echoed(self, result):
+        self.delayed_call = self.protocol.reactor.callLater(self.timeout, self.finish)
+        return result
+
+    def cleanedUp(self, address):
+        if address in self.members:
+            self.acked.add(address)
+            if len(self.acked) == len(self.members):
+                self.finish()
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+        self.protocol._removeGroupCommand(self)
+        self.deferred.callback(self.members - self.acked)
+
+    def fail(self, reason):
+        # the PLM didn't take the broadcast, nobody got it
+        if self.finished:
+            return
+        self.finished = True
+        self.protocol._removeGroupCommand(self)
+        self.deferred.callback(self.members)
@@ -0,0 +1,167 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from twisted.internet import defer
+
+import random
+
+from .. import log
+from .request import InsteonDeviceNAKError
+from .request import InsteonNAKError
+from .request import InsteonTimeoutError
+
+class RetryPolicy(object):
+    """How often and how soon a failed direct message is sent again.
+
+    Timeouts and PLM NAKs are retried up to attempts times in all,
+    waiting backoff seconds before the first retry and factor times
+    longer before each further one, capped at max_backoff.  Each wait
+    is spread by up to jitter of itself either way so retries of many
+    requests don't line up.  A NAK from the device itself is final."""
+
+    def __init__(self, attempts = 3, backoff = 0.5, factor = 2.0, max_backoff = 8.0, jitter = 0.25):
+        if attempts < 1:
+            raise ValueError('attempts must be at least 1')
+
+        self.attempts = attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.random = random.Random()
+
+    def delay(self, attempt):
+        """Seconds to wait after the attempt'th attempt failed."""
+
+        delay = min(self.max_backoff, self.backoff * self.factor ** (attempt - 1))
+        return delay * (1.0 + self.random.uniform(-self.jitter, self.jitter))
+
+    def retryable(self, reason):
+        if reason.check(InsteonDeviceNAKError):
+            return False
+        return reason.check(InsteonTimeoutError, InsteonNAKError) is not None
+
+class CircuitBreaker(object):
+    """Stop traffic to a device that stopped answering.
+
+    After threshold failures in a row the breaker opens and probe is
+    called every probe_interval seconds, twice as long after each
+    probe that fails up to max_probe_interval, until success() closes
+    it again.  probe must return a Deferred."""
+
+    threshold = 5
+    probe_interval = 15.0
+    max_probe_interval = 600.0
+
+    def __init__(self, reactor, probe, name = None):
+        self.reactor = reactor
+        self.probe = probe
+        self.name = name
+        self.failures = 0
+        self.open = False
+        self.opened_at = None
+        self.interval = self.probe_interval
+        self.probe_call = None
+
+    def success(self):
+        self.failures = 0
+        if not self.open:
+            return
+
+        log.informational('{} is answering again after {:.1f}s', self.name, self.reactor.seconds() - self.opened_at)
+        self.open = False
+        self.opened_at = None
+        self.interval = self.probe_interval
+        if self.probe_call is not None and self.probe_call.active():
+            self.probe_call.cancel()
+        self.probe_call = None
+
+    def failure(self):
+        self.failures += 1
+        if self.open or self.failures < self.threshold:
+            return
+
+        log.warning('{} stopped answering, parking traffic to it', self.name)
+        self.open = True
+        self.opened_at = self.reactor.seconds()
+        self._schedule()
+
+    def _schedule(self):
+        self.probe_call = self.reactor.callLater(self.interval, self._probe)
+
+    def _probe(self):
+        self.probe_call = None
+        d = defer.maybeDeferred(self.probe)
+        d.addErrback(self._probeFailed)
+
+    def _probeFailed(self, reason):
+        log.debug('probing {} failed: {}', self.name, reason.getErrorMessage())
+        if self.open and self.probe_call is None:
+            self.interval = min(self.max_probe_interval, self.interval * 2)
+            self._schedule()
+
+class _Retry(object):
+    """Send a message again according to a RetryPolicy until it
+    succeeds, fails for good or the device's breaker opens."""
+
+    def __init__(self, protocol, policy, breaker, send):
+        self.protocol = protocol
+        self.policy = policy
+        self.breaker = breaker
+        self.send = send
+        self.attempt = 0
+        self.current = None
+        self.delayed_call = None
+        self.deferred = defer.Deferred(canceller = self._cancel)
+
+    def start(self):
+        self._attempt()
+        return self.deferred
+
+    def _attempt(self):
+        self.delayed_call = None
+        self.attempt += 1
+        self.current = self.send()
+        self.current.addCallbacks(self._succeeded, self._failed)
+
+    def _succeeded(self, result):
+        self.current = None
+        self.deferred.callback(result)
+
+    def _failed(self, reason):
+        self.current = None
+        if self.deferred.called:
+            return
+
+        if self.attempt >= self.policy.attempts or not self.policy.retryable(reason) or self.breaker.open:
+            self.deferred.errback(reason)
+            return
+
+        # a timeout has already raised the device's hop count, so the
+        # retry goes out with more hops
+        delay = self.policy.delay(self.attempt)
+        log.debug('attempt {:d} failed, retrying in {:.2f}s: {}', self.attempt, delay, reason.getErrorMessage())
+        self.delayed_call = self.protocol.reactor.callLater(delay, self._attempt)
+
+    def _cancel(self, d):
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+        if self.current is not None:
+            self.current.cancel()
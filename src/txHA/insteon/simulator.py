@@ -0,0 +1,440 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A stand-in for a PLM and the devices behind it, for load testing
+# without hardware:
+#
+#   python -m txHA.insteon.simulator --devices 2000 --port 9761
+#
+# then point InsteonNetworkPLM at localhost, or use --pty and point
+# InsteonSerialPLM at the printed device.
+
+from __future__ import absolute_import
+
+from twisted.internet import endpoints
+from twisted.internet import protocol
+from twisted.internet import stdio
+
+import argparse
+import os
+import random
+import struct
+import tty
+
+from .. import log
+from . import InsteonAddress
+from . import InsteonMessageFlags
+
+ACK = '\x06'
+NAK = '\x15'
+
+# flags of the replies the simulated devices send
+_direct_ack = InsteonMessageFlags(0x2b)
+_group_broadcast = InsteonMessageFlags(0xcb)
+_broadcast = InsteonMessageFlags(0x8b)
+_cleanup_ack = InsteonMessageFlags(0x6b)
+
+# length of the commands the host sends, 0x62 is handled separately
+# because its length depends on the extended flag
+_command_lengths = {0x60: 2,
+                    0x61: 5,
+                    0x63: 4,
+                    0x64: 4,
+                    0x65: 2,
+                    0x66: 5,
+                    0x67: 2,
+                    0x69: 2,
+                    0x6a: 2,
+                    0x6b: 3,
+                    0x6c: 2,
+                    0x6d: 2,
+                    0x6e: 2,
+                    0x6f: 11,
+                    0x72: 4,
+                    0x73: 2}
+
+class SimulatedDevice(object):
+    """A dimmer that answers direct commands and keeps its level.
+    Messages to and from it need hops retransmissions to get through."""
+
+    def __init__(self, address, group = 1, category = 0x01, subcategory = 0x20, firmware = 0x41, level = 0,
+                 hops = 0):
+        self.address = address
+        self.group = group
+        self.hops = hops
+        self.category = category
+        self.subcategory = subcategory
+        self.firmware = firmware
+        self.level = level
+        self.database_delta = 0
+
+    def handle(self, command_1, command_2):
+        """Apply a direct command and return command 1 and 2 of the
+        ACK."""
+
+        if command_1 == 0x19:
+            return self.database_delta, self.level
+
+        if command_1 in (0x11, 0x12):
+            self.level = command_2
+
+        elif command_1 in (0x13, 0x14):
+            self.level = 0
+
+        elif command_1 == 0x15:
+            self.level = min(0xff, self.level + 0x20)
+
+        elif command_1 == 0x16:
+            self.level = max(0x00, self.level - 0x20)
+
+        elif command_1 == 0x0d:
+            return command_1, 0x02
+
+        return command_1, command_2
+
+    def flags(self, flags):
+        """flags as they arrive at the PLM after hops retransmissions."""
+
+        return flags.replace(hops_left = flags.max_hops - self.hops)
+
+class SimulatedNetwork(object):
+    """The devices behind a simulated PLM.
+
+    The PLM echoes each command echo_latency seconds after receiving
+    it and NAKs a fraction nak_rate of them as if it were busy.
+    Devices answer ack_latency seconds after the echo, except for a
+    fraction drop_rate of the messages that are lost on the powerline.
+    Devices are linked to the PLM in groups of group_size, starting
+    with group 1, and are spread over 0 to hops hops away, direct
+    messages with fewer max hops than that never arrive.
+
+    With chatter_interval set, each device sends a group broadcast on
+    average that often.  Chatter is a single timer for the whole
+    network, so thousands of devices don't cost thousands of timers."""
+
+    def __init__(self, reactor, devices = 0, address = '1E.BA.FA', ack_latency = 0.05, echo_latency = 0.0,
+                 nak_rate = 0.0, drop_rate = 0.0, chatter_interval = None, seed = None, group_size = 20,
+                 hops = 0):
+        self.reactor = reactor
+        self.address = InsteonAddress(address)
+        self.ack_latency = ack_latency
+        self.echo_latency = echo_latency
+        self.nak_rate = nak_rate
+        self.drop_rate = drop_rate
+        self.chatter_interval = chatter_interval
+        self.random = random.Random(seed)
+        self.devices = {}
+        self.order = []
+        self.groups = {}
+        self.clients = []
+        self.chatter_call = None
+
+        self.received = 0
+        self.sent = 0
+        self.naks = 0
+        self.drops = 0
+
+        for index in range(devices):
+            # skip 00.00.xx, those look like group numbers
+            self.addDevice(InsteonAddress.from_bytes(struct.pack('!I', 0x100000 + index)[1:]),
+                           group = 1 + index // group_size, hops = index % (hops + 1))
+
+    def addDevice(self, address, **kw):
+        device = SimulatedDevice(address, **kw)
+        self.devices[address] = device
+        self.order.append(device)
+        self.groups.setdefault(device.group, []).append(device)
+        return device
+
+    def addClient(self, client):
+        self.clients.append(client)
+        if self.chatter_interval is not None and self.chatter_call is None:
+            self._scheduleChatter()
+
+    def removeClient(self, client):
+        self.clients.remove(client)
+        if not self.clients and self.chatter_call is not None:
+            if self.chatter_call.active():
+                self.chatter_call.cancel()
+            self.chatter_call = None
+
+    def later(self, delay, client, data):
+        if delay > 0:
+            self.reactor.callLater(delay, client.send, data)
+        else:
+            client.send(data)
+
+    def busy(self):
+        if self.nak_rate and self.random.random() < self.nak_rate:
+            self.naks += 1
+            return True
+        return False
+
+    def lost(self):
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            self.drops += 1
+            return True
+        return False
+
+    def _scheduleChatter(self):
+        # the broadcasts of all devices together form one poisson
+        # process with the sum of their rates
+        rate = len(self.order) / self.chatter_interval
+        if rate <= 0:
+            self.chatter_call = None
+            return
+        self.chatter_call = self.reactor.callLater(self.random.expovariate(rate), self._chatter)
+
+    def _chatter(self):
+        device = self.random.choice(self.order)
+        if self.random.random() < 0.5:
+            command_1 = 0x11
+            device.level = 0xff
+        else:
+            command_1 = 0x13
+            device.level = 0x00
+
+        frame = struct.pack('!BB3s3scBB', 0x02, 0x50, device.address.binary, '\x00\x00\x01',
+                            device.flags(_group_broadcast).binary, command_1, 0x00)
+        for client in self.clients:
+            client.send(frame)
+
+        self._scheduleChatter()
+
+class SimulatedPLMProtocol(protocol.Protocol):
+    """Speak the PLM side of the serial protocol to one host."""
+
+    def __init__(self, network):
+        self.network = network
+        self.buffer = ''
+        self.cursor = None
+        self.handlers = {0x60: self._getIMInfo,
+                         0x61: self._sendAllLinkCommand,
+                         0x62: self._sendMessage,
+                         0x69: self._getFirstAllLinkRecord,
+                         0x6a: self._getNextAllLinkRecord,
+                         0x73: self._getIMConfiguration}
+
+    def connectionMade(self):
+        self.network.addClient(self)
+
+    def connectionLost(self, reason):
+        if self in self.network.clients:
+            self.network.removeClient(self)
+
+    def send(self, data):
+        if self.transport is None or not self.connected:
+            return
+        self.network.sent += 1
+        self.transport.write(data)
+
+    def dataReceived(self, data):
+        self.buffer += data
+        buffer = self.buffer
+        offset = 0
+        size = len(buffer)
+
+        while offset < size:
+            if buffer[offset] != '\x02':
+                # the PLM answers garbage with a bare NAK
+                start = buffer.find('\x02', offset)
+                if start < 0:
+                    start = size
+                self.send(NAK)
+                offset = start
+                continue
+
+            if offset + 2 > size:
+                break
+
+            command = ord(buffer[offset + 1])
+            if command == 0x62:
+                if offset + 6 > size:
+                    break
+                length = 22 if ord(buffer[offset + 5]) & 0x10 else 8
+
+            else:
+                length = _command_lengths.get(command)
+                if length is None:
+                    self.send(NAK)
+                    offset += 1
+                    continue
+
+            if offset + length > size:
+                break
+
+            frame = buffer[offset:offset + length]
+            offset += length
+            self.network.received += 1
+            self.handlers.get(command, self._echo)(frame)
+
+        self.buffer = buffer[offset:]
+
+    def _echo(self, frame, data = ''):
+        if self.network.busy():
+            self.network.later(self.network.echo_latency, self, frame + data + NAK)
+            return False
+
+        self.network.later(self.network.echo_latency, self, frame + data + ACK)
+        return True
+
+    def _getIMInfo(self, frame):
+        self._echo(frame, self.network.address.binary + '\x03\x15\x9c')
+
+    def _getIMConfiguration(self, frame):
+        self._echo(frame, '\x00\x00\x00')
+
+    def _sendMessage(self, frame):
+        if not self._echo(frame):
+            return
+
+        device = self.network.devices.get(InsteonAddress.from_bytes(frame[2:5]))
+        if device is None or self.network.lost():
+            return
+
+        if ord(frame[5]) & 0x03 < device.hops:
+            # ran out of hops on the way
+            self.network.drops += 1
+            return
+
+        command_1, command_2 = device.handle(ord(frame[6]), ord(frame[7]))
+        reply = struct.pack('!BB3s3scBB', 0x02, 0x50, device.address.binary, self.network.address.binary,
+                            device.flags(_direct_ack).binary, command_1, command_2)
+        self.network.later(self.network.echo_latency + self.network.ack_latency, self, reply)
+
+        if command_1 == 0x10:
+            # an ID request is followed by the device's set button
+            # broadcast, which carries its identity in the to address
+            identity = struct.pack('!BB3sBBBcBB', 0x02, 0x50, device.address.binary,
+                                   device.category, device.subcategory, device.firmware,
+                                   device.flags(_broadcast).binary, 0x01, 0x00)
+            self.network.later(self.network.echo_latency + 2 * self.network.ack_latency, self, identity)
+
+    def _sendAllLinkCommand(self, frame):
+        if not self._echo(frame):
+            return
+
+        # group commands carry no level so on means full on.  The PLM
+        # then cleans up every member in turn and reports the ones that
+        # didn't answer, and finally whether all of them did.
+        group = ord(frame[2])
+        command_1 = ord(frame[3])
+        command_2 = 0xff if command_1 in (0x11, 0x12) else ord(frame[4])
+        delay = self.network.echo_latency
+        missed = False
+        for device in self.network.groups.get(group, ()):
+            delay += self.network.ack_latency
+            if self.network.lost():
+                missed = True
+                self.network.later(delay, self, struct.pack('!BBBB3s', 0x02, 0x56, 0x01, group, device.address.binary))
+                continue
+
+            device.handle(command_1, command_2)
+            ack = struct.pack('!BB3s3scBB', 0x02, 0x50, device.address.binary, self.network.address.binary,
+                              device.flags(_cleanup_ack).binary, command_1, group)
+            self.network.later(delay, self, ack)
+
+        self.network.later(delay + self.network.ack_latency, self, '\x02\x58' + (NAK if missed else ACK))
+
+    def _getFirstAllLinkRecord(self, frame):
+        self.cursor = 0
+        self._allLinkRecord(frame)
+
+    def _getNextAllLinkRecord(self, frame):
+        if self.cursor is None:
+            self.network.later(self.network.echo_latency, self, frame + NAK)
+            return
+        self._allLinkRecord(frame)
+
+    def _allLinkRecord(self, frame):
+        order = self.network.order
+        if self.cursor >= len(order):
+            # a NAK is the end of the database
+            self.cursor = None
+            self.network.later(self.network.echo_latency, self, frame + NAK)
+            return
+
+        if not self._echo(frame):
+            return
+
+        device = order[self.cursor]
+        self.cursor += 1
+        record = struct.pack('!BBBB3sBBB', 0x02, 0x57, 0xe2, device.group, device.address.binary,
+                             device.category, device.subcategory, device.firmware)
+        self.network.later(self.network.echo_latency, self, record)
+
+class SimulatedPLMFactory(protocol.Factory):
+    def __init__(self, network):
+        self.network = network
+
+    def buildProtocol(self, addr):
+        p = SimulatedPLMProtocol(self.network)
+        p.factory = self
+        return p
+
+def listenPTY(reactor, network):
+    """Serve the simulated PLM on a new pseudo terminal and return the
+    name of the device to open."""
+
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    # the reactor tracks readers and writers by descriptor, so reading
+    # and writing need one each
+    stdio.StandardIO(SimulatedPLMProtocol(network), stdin = master, stdout = os.dup(master), reactor = reactor)
+    return os.ttyname(slave)
+
+def main():
+    from twisted.internet import reactor
+
+    parser = argparse.ArgumentParser(description = 'Simulate an Insteon PLM and its devices.')
+    parser.add_argument('--devices', type = int, default = 100)
+    parser.add_argument('--port', type = int, default = 9761)
+    parser.add_argument('--pty', action = 'store_true', help = 'serve on a pseudo terminal instead of TCP')
+    parser.add_argument('--ack-latency', type = float, default = 0.05)
+    parser.add_argument('--echo-latency', type = float, default = 0.0)
+    parser.add_argument('--nak-rate', type = float, default = 0.0)
+    parser.add_argument('--drop-rate', type = float, default = 0.0)
+    parser.add_argument('--chatter-interval', type = float, default = None)
+    parser.add_argument('--seed', type = int, default = None)
+    parser.add_argument('--hops', type = int, default = 0, help = 'spread devices up to this many hops away')
+    args = parser.parse_args()
+
+    log.setup(reactor, log.INFO, 'plm-simulator')
+
+    network = SimulatedNetwork(reactor,
+                               devices = args.devices,
+                               ack_latency = args.ack_latency,
+                               echo_latency = args.echo_latency,
+                               nak_rate = args.nak_rate,
+                               drop_rate = args.drop_rate,
+                               chatter_interval = args.chatter_interval,
+                               seed = args.seed,
+                               hops = args.hops)
+
+    if args.pty:
+        log.notice('simulated PLM on {}', listenPTY(reactor, network))
+
+    else:
+        endpoint = endpoints.serverFromString(reactor, 'tcp:{}'.format(args.port))
+        endpoint.listen(SimulatedPLMFactory(network))
+        log.notice('simulated PLM on port {}', args.port)
+
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -31,7 +31,6 @@ from twisted.python import log as _log
 
 import re
 import struct
-import inspect
 import traceback
 
 EMERGENCY, ALERT, CRITICAL, ERROR, WARNING, NOTICE, INFORMATIONAL, DEBUG = range(8)
@@ -53,8 +52,14 @@ class JournalClientProtocol(protocol.ConnectedDatagramProtocol):
         pass
 
     def write(self, data):
-        if self.running:
-            self.transport.write(data)
+        """Returns False if the datagram couldn't be sent."""
+
+        if not self.running:
+            return False
+
+        # the port silently drops the datagram when the socket buffer
+        # is full rather than blocking
+        return self.transport.write(data) is not None
 
 class JournalMessage(object):
     name_re = re.compile(r'[A-Z0-9][_A-Z0-9]*')
@@ -64,39 +69,86 @@ class JournalMessage(object):
                   'CODE_LINE': lambda priority: '{:d}'.format(priority)}
 
     def __init__(self):
-        self.data = b''
+        self.parts = []
+
+    @property
+    def data(self):
+        return b''.join(self.parts)
 
     def add(self, name, value):
         match = self.name_re.match(name)
         if not match:
-            raise RuntimeException('bad name!')
-
-        self.data += bytes(name)
+            raise ValueError('bad name!')
 
         if name in self.converters:
             value = self.converters[name](value)
 
-        else:
+        elif isinstance(value, unicode):
             value = value.encode('utf-8')
 
         match = self.binary_re.search(value)
         if match:
-            self.data += '\n'
-            self.data += struct.pack('<Q', len(value))
-            self.data += value
-            self.data += '\n'
+            self.parts.extend((bytes(name), '\n', struct.pack('<Q', len(value)), value, '\n'))
 
         else:
-            self.data += '='
-            self.data += value
-            self.data += '\n'
+            self.parts.extend((bytes(name), '=', value, '\n'))
+
+class BufferedTransport(object):
+    """Collect log output and hand it to write() in batches.
+
+    A batch is written when flush_size bytes have been collected, after
+    flush_interval seconds, for anything at CRITICAL or worse (which
+    stops the reactor) and when the reactor shuts down.  If more than
+    max_size bytes are waiting, new messages are dropped and counted
+    in dropped instead of blocking the reactor."""
+
+    flush_interval = 0.1
+    flush_size = 64 * 1024
+    max_size = 1024 * 1024
 
-class JournalTransport(object):
     def __init__(self, reactor):
         self.reactor = reactor
+        self.buffer = []
+        self.size = 0
+        self.dropped = 0
+        self.delayed_call = None
+        self.reactor.addSystemEventTrigger('before', 'shutdown', self.flush)
+
+    def queue(self, data, urgent = False):
+        if self.size + len(data) > self.max_size:
+            self.dropped += 1
+            return
+
+        self.buffer.append(data)
+        self.size += len(data)
+
+        if urgent or self.size >= self.flush_size:
+            self.flush()
+
+        elif self.delayed_call is None:
+            self.delayed_call = self.reactor.callLater(self.flush_interval, self.flush)
+
+    def flush(self):
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+
+        if not self.buffer:
+            return
+
+        buffer, self.buffer = self.buffer, []
+        self.size = 0
+        self.write(buffer)
+
+    def write(self, buffer):
+        raise NotImplementedError
+
+class JournalTransport(BufferedTransport):
+    def __init__(self, reactor, path = '/run/systemd/journal/socket'):
+        super(JournalTransport, self).__init__(reactor)
+        self.path = path
         self.journal = JournalClientProtocol(self.reactor)
-        self.reactor.connectUNIXDatagram('/run/systemd/journal/socket',
-                                         self.journal)
+        self.reactor.connectUNIXDatagram(self.path, self.journal)
 
     def send(self, event, text):
         message = JournalMessage()
@@ -120,19 +172,26 @@ class JournalTransport(object):
 
         message.add('MESSAGE', text)
 
-        self.journal.write(message.data)
+        self.queue(message.data, event['PRIORITY'] <= CRITICAL)
 
-class StderrTransport(object):
-    def __init__(self, reactor):
-        self.reactor = reactor
+    def write(self, buffer):
+        # the journal wants exactly one entry per datagram
+        for data in buffer:
+            if not self.journal.write(data):
+                self.dropped += 1
 
+class StderrTransport(BufferedTransport):
     def send(self, event, text):
+        text += '\n'
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.queue(text, event['PRIORITY'] <= CRITICAL)
+
+    def write(self, buffer):
         global stderr_write
         global stderr_flush
 
-        text += '\n'
-        text = text.encode('utf-8')
-        util.untilConcludes(stderr_write, text)
+        util.untilConcludes(stderr_write, b''.join(buffer))
         util.untilConcludes(stderr_flush)
 
 class Observer(object):
@@ -156,6 +215,9 @@ class Observer(object):
         else:
             event['PRIORITY'] = DEBUG
 
+        if event['PRIORITY'] > self.priority:
+            return
+
         if 'SYSLOG_IDENTIFIER' not in event and self.appname is not None:
             event['SYSLOG_IDENTIFIER'] = self.appname
 
@@ -169,19 +231,63 @@ class Observer(object):
         for transport in self.transports:
             transport.send(event, text)
 
-        if eventDict['PRIORITY'] <= CRITICAL:
+        if event['PRIORITY'] <= CRITICAL:
             self.reactor.stop()
 
-def introspect(func):
-    def _introspect(*args, **kw):
-        if ('CODE_FILE' not in kw or
-            'CODE_LINE' not in kw or
-            'CODE_FUNC' not in kw):
-            (kw['CODE_FILE'],
-             kw['CODE_LINE'],
-             kw['CODE_FUNC']) = inspect.stack()[1][1:4]
-        func(*args, **kw)
-    return _introspect
+# record the file, line and function of the caller with every event
+introspection = True
+
+# events less important than this are thrown away before any work is
+# done, including formatting the message
+threshold = DEBUG
+
+def setIntrospection(enabled):
+    global introspection
+    introspection = enabled
+
+def setPriority(priority):
+    global threshold
+    threshold = priority
+    if logger is not None:
+        logger.priority = priority
+        logger.observer.priority = priority
+
+def enabled(priority):
+    return priority <= threshold
+
+def render(args):
+    """Turn lazy message arguments into the message itself.  A single
+    callable is called, a format string followed by arguments is
+    formatted with str.format.  Only done once an event has passed the
+    priority check."""
+
+    if len(args) == 1 and callable(args[0]):
+        return (args[0](),)
+
+    if len(args) > 1 and isinstance(args[0], basestring):
+        return (args[0].format(*args[1:]),)
+
+    return args
+
+def introspect(default):
+    def decorator(func):
+        def _introspect(*args, **kw):
+            # errors logged through msg() by Twisted itself carry no
+            # priority of their own
+            if kw.get('PRIORITY', ERROR if kw.get('isError') else default) > threshold:
+                return
+
+            # only look at the immediate caller's frame, never read any
+            # source, and leave it to the outermost logging call
+            if introspection and 'CODE_FUNC' not in kw:
+                frame = sys._getframe(1)
+                code = frame.f_code
+                kw['CODE_FILE'] = code.co_filename
+                kw['CODE_LINE'] = frame.f_lineno
+                kw['CODE_FUNC'] = code.co_name
+            func(*args, **kw)
+        return _introspect
+    return decorator
 
 class Logger(object):
     def __init__(self, reactor, priority, appname, transports):
@@ -192,18 +298,22 @@ class Logger(object):
 
         self.observer = Observer(self.reactor, self.priority, self.appname, self.transports)
 
+        global threshold
+        threshold = priority
+
         _log.msg = self.msg
         _log.err = self.err
         _log.startLoggingWithObserver(self.observer.emit, setStdout = 1)
 
-    @introspect
+    @introspect(DEBUG)
     def msg(self, *args, **kw):
         if 'PRIORITY' not in kw:
-            kw['PRIORITY'] = DEBUG
+            kw['PRIORITY'] = ERROR if kw.get('isError') else DEBUG
         _log.theLogPublisher.msg(*args, **kw)
 
-    @introspect
+    @introspect(ERROR)
     def err(self, _stuff = None, _why = None, **kw):
+        kw.setdefault('PRIORITY', ERROR)
         if _stuff is None:
             _stuff = failure.Failure()
         if isinstance(_stuff, failure.Failure):
@@ -221,52 +331,52 @@ class Logger(object):
                      why = _why,
                      isError = 1,
                      **kw)
-     
-    @introspect
+
+    @introspect(DEBUG)
     def debug(self, *args, **kw):
         kw['PRIORITY'] = DEBUG
-        self.msg(*args, **kw)
+        self.msg(*render(args), **kw)
 
     trace = debug
 
-    @introspect
+    @introspect(INFORMATIONAL)
     def informational(self, *args, **kw):
         kw['PRIORITY'] = INFORMATIONAL
-        self.msg(*args, **kw)
+        self.msg(*render(args), **kw)
 
     info = informational
 
-    @introspect
+    @introspect(NOTICE)
     def notice(self, *args, **kw):
         kw['PRIORITY'] = NOTICE
-        self.msg(*args, **kw)
+        self.msg(*render(args), **kw)
 
-    @introspect
+    @introspect(WARNING)
     def warning(self, *args, **kw):
         kw['PRIORITY'] = WARNING
-        self.msg(*args, **kw)
+        self.msg(*render(args), **kw)
 
-    @introspect
+    @introspect(ERROR)
     def error(self, *args, **kw):
         kw['PRIORITY'] = ERROR
-        self.msg(*args, **kw)
+        self.msg(*render(args), **kw)
 
-    @introspect
+    @introspect(CRITICAL)
     def critical(self, *args, **kw):
         kw['PRIORITY'] = CRITICAL
-        self.msg(*args, **kw)
+        self.msg(*render(args), **kw)
 
-    @introspect
+    @introspect(ALERT)
     def alert(self, *args, **kw):
         kw['PRIORITY'] = ALERT
-        self.msg(*args, **kw)
+        self.msg(*render(args), **kw)
 
-    @introspect
+    @introspect(EMERGENCY)
     def emergency(self, *args, **kw):
         kw['PRIORITY'] = EMERGENCY
-        self.msg(*args, **kw)
+        self.msg(*render(args), **kw)
 
-    @introspect
+    @introspect(CRITICAL)
     def errback(self, failure, *args, **kw):
         if 'PRIORITY' not in kw:
             kw['PRIORITY'] = CRITICAL
@@ -282,7 +392,7 @@ def setup(reactor, priority, appname):
 
     logger = Logger(reactor, priority, appname, transports = [JournalTransport(reactor),
                                                               StderrTransport(reactor)])
-@introspect
+@introspect(DEBUG)
 def msg(*args, **kw):
     if logger is None:
         util.untilConcludes(stderr_write, repr((args, kw)))
@@ -291,8 +401,9 @@ def msg(*args, **kw):
     else:
         logger.msg(*args, **kw)
 
-@introspect
+@introspect(ERROR)
 def err(_stuff = None, _why = None, **kw):
+    kw.setdefault('PRIORITY', ERROR)
     if logger is None:
         util.untilConcludes(stderr_write, repr((_stuff, _why, kw)))
         util.untilConcludes(stderr_flush)
@@ -300,51 +411,51 @@ def err(_stuff = None, _why = None, **kw):
     else:
         logger.err(_stuff, _why, **kw)
 
-@introspect
+@introspect(DEBUG)
 def debug(*args, **kw):
     kw['PRIORITY'] = DEBUG
-    msg(*args, **kw)
+    msg(*render(args), **kw)
 
 trace = debug
 
-@introspect
+@introspect(INFORMATIONAL)
 def informational(*args, **kw):
     kw['PRIORITY'] = INFORMATIONAL
-    msg(*args, **kw)
+    msg(*render(args), **kw)
 
 info = informational
 
-@introspect
+@introspect(NOTICE)
 def notice(*args, **kw):
     kw['PRIORITY'] = NOTICE
-    msg(*args, **kw)
+    msg(*render(args), **kw)
 
-@introspect
+@introspect(WARNING)
 def warning(*args, **kw):
     kw['PRIORITY'] = WARNING
-    msg(*args, **kw)
+    msg(*render(args), **kw)
 
-@introspect
+@introspect(ERROR)
 def error(*args, **kw):
     kw['PRIORITY'] = ERROR
-    msg(*args, **kw)
+    msg(*render(args), **kw)
 
-@introspect
+@introspect(CRITICAL)
 def critical(*args, **kw):
     kw['PRIORITY'] = CRITICAL
-    msg(*args, **kw)
+    msg(*render(args), **kw)
 
-@introspect
+@introspect(ALERT)
 def alert(*args, **kw):
     kw['PRIORITY'] = ALERT
-    msg(*args, **kw)
+    msg(*render(args), **kw)
 
-@introspect
+@introspect(EMERGENCY)
 def emergency(*args, **kw):
     kw['PRIORITY'] = EMERGENCY
-    msg(*args, **kw)
+    msg(*render(args), **kw)
 
-@introspect
+@introspect(CRITICAL)
 def errback(failure, *args, **kw):
     if 'PRIORITY' not in kw:
         kw['PRIORITY'] = CRITICAL
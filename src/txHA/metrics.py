@@ -0,0 +1,113 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2013
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from twisted.internet import endpoints
+from twisted.web import resource
+from twisted.web import server
+
+from .histogram import LATENCY_BOUNDS
+from .histogram import Histogram
+
+def _name(*parts):
+    return '_'.join(('txha',) + parts)
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value) for key, value in sorted(labels.items())) + '}'
+
+def _histogram(lines, name, snapshot, labels = None):
+    labels = dict(labels or {})
+    total = 0
+    for bound, count in zip(snapshot['bounds'] + ['+Inf'], snapshot['buckets']):
+        total += count
+        labels['le'] = bound
+        lines.append('{}_bucket{} {}'.format(name, _labels(labels), total))
+    del labels['le']
+    lines.append('{}_sum{} {!r}'.format(name, _labels(labels), snapshot['sum']))
+    lines.append('{}_count{} {}'.format(name, _labels(labels), snapshot['count']))
+
+def render(metrics):
+    """Turn the result of _InsteonBaseProtocol.getMetrics() into the
+    Prometheus text format."""
+
+    lines = []
+
+    for direction in ('in', 'out'):
+        name = _name('frames', direction, 'total')
+        lines.append('# TYPE {} counter'.format(name))
+        for command, count in sorted(metrics['frames_' + direction].items()):
+            lines.append('{}{} {}'.format(name, _labels({'command': '0x{:02x}'.format(command)}), count))
+
+    for counter in ('naks', 'timeouts'):
+        name = _name(counter, 'total')
+        lines.append('# TYPE {} counter'.format(name))
+        for source, count in sorted(metrics[counter].items()):
+            lines.append('{}{} {}'.format(name, _labels({'source': source}), count))
+
+    for counter in ('discarded', 'resyncs'):
+        name = _name('decoder', counter, 'total')
+        lines.append('# TYPE {} counter'.format(name))
+        lines.append('{} {}'.format(name, metrics['decoder'][counter]))
+
+    for gauge in ('outstanding', 'send_rate'):
+        name = _name(gauge)
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{} {!r}'.format(name, metrics[gauge]))
+
+    name = _name('queue', 'depth')
+    lines.append('# TYPE {} gauge'.format(name))
+    for lane, stats in enumerate(metrics['queue']):
+        lines.append('{}{} {}'.format(name, _labels({'lane': lane}), stats['depth']))
+
+    name = _name('queue', 'wait', 'seconds')
+    lines.append('# TYPE {} histogram'.format(name))
+    for lane, stats in enumerate(metrics['queue']):
+        _histogram(lines, name, stats['wait'], {'lane': lane})
+
+    for latency in ('echo_latency', 'ack_latency'):
+        name = _name(latency, 'seconds')
+        lines.append('# TYPE {} histogram'.format(name))
+        _histogram(lines, name, metrics[latency])
+
+    lines.append('')
+    return '\n'.join(lines)
+
+class MetricsResource(resource.Resource):
+    """Serve the metrics of a PLM as text."""
+
+    isLeaf = True
+
+    def __init__(self, plm):
+        resource.Resource.__init__(self)
+        self.plm = plm
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        if self.plm.protocol is None:
+            request.setResponseCode(503)
+            return 'not connected\n'
+        return render(self.plm.getMetrics())
+
+def listen(reactor, plm, port = 9762, interface = '127.0.0.1'):
+    """Export the metrics of plm over HTTP, only on the loopback
+    interface unless told otherwise."""
+
+    endpoint = endpoints.TCP4ServerEndpoint(reactor, port, interface = interface)
+    return endpoint.listen(server.Site(MetricsResource(plm)))
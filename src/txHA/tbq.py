@@ -19,69 +19,217 @@ from __future__ import absolute_import
 
 from twisted.internet import defer
 
+import collections
+
 from . import log
+from .histogram import Histogram
+
+INTERACTIVE, NORMAL, BACKGROUND = range(3)
+
+class LaneStats(object):
+    """How long objects sat in one priority lane before being handed
+    out."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.wait = Histogram()
+
+    def add(self, wait):
+        self.count += 1
+        self.total_wait += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
+        self.wait.observe(wait)
+
+    @property
+    def mean_wait(self):
+        if self.count == 0:
+            return 0.0
+        return self.total_wait / self.count
 
 class TokenBucketQueue(object):
-    def __init__(self, reactor, token_rate, bucket_size, token_cost = 1.0, start_paused = False):
+    """Hand out queued objects at no more than token_rate tokens per
+    second, each object costing token_cost tokens, allowing bursts of
+    up to bucket_size tokens.  Rates don't have to be whole numbers,
+    a token_rate of 2.5 hands out an object every 0.4 seconds.
+
+    Tokens are computed from the reactor's clock when they are needed
+    rather than added by a periodic timer, so an idle queue doesn't
+    wake up at all and an object is handed out immediately when a
+    token is available.  A single timer is only scheduled while
+    somebody is waiting for an object that is already queued.
+
+    Cancelled gets are left in place and skipped when they reach the
+    front of the queue, so cancellation is O(1) just like put and
+    get.
+
+    Objects are put into one of several priority lanes, INTERACTIVE
+    first.  Without weights a lower lane is only served when every
+    higher lane is empty.  With weights (one per lane) the lanes share
+    the tokens in proportion to their weights using smooth weighted
+    round robin, so background work keeps trickling out under load."""
+
+    # never schedule the timer closer than this, rounding can leave the
+    # bucket a hair short of a token which would otherwise spin
+    minimum_delay = 0.001
+
+    def __init__(self, reactor, token_rate, bucket_size, token_cost = 1.0, start_paused = False, lanes = 3, weights = None):
+        if token_rate <= 0:
+            raise ValueError('token_rate must be positive')
+
+        if weights is not None and len(weights) != lanes:
+            raise ValueError('need exactly one weight per lane')
+
         self.reactor = reactor
-        self.token_rate = token_rate
+        self.token_rate = float(token_rate)
         self.bucket_size = bucket_size
         self.token_cost = token_cost
         self.paused = start_paused
-        self.tokens = 0.0
-        self.waiting = []
-        self.pending = []
+        self.tokens = float(bucket_size)
+        self.last = self.reactor.seconds()
+        self.waiting = collections.deque()
+        self.lanes = [collections.deque() for lane in range(lanes)]
+        self.weights = weights
+        self.credits = [0] * lanes
+        self.lane_stats = [LaneStats() for lane in range(lanes)]
+        self.pending = 0
         self.delayed_call = None
 
-        if not self.paused:
-            self.delayed_call = self.reactor.callLater(0.0, self._add)
+        if self.paused:
             log.debug('TBQ starting paused!')
 
     def pause(self):
         log.debug('TBQ pausing!')
-        if self.delayed_call is not None and self.delayed_call.active():
-            self.delayed_call.cancel()
-        self.delayed_call = None
+        self._refill()
+        self._cancelTimer()
         self.paused = True
 
     def resume(self):
         log.debug('TBQ resuming!')
         self.paused = False
-        if self.delayed_call is None or not self.delayed_call.active():
-            self.delayed_call = self.reactor.callLater(0.0, self._add)
+        self.last = self.reactor.seconds()
+        self._run()
 
-    def _add(self):
-        log.debug('TBQ adding token!')
-        if self.paused:
+    def setRate(self, token_rate):
+        if token_rate <= 0:
+            raise ValueError('token_rate must be positive')
+
+        # settle the tokens earned at the old rate before switching
+        self._refill()
+        self.token_rate = float(token_rate)
+        if self.delayed_call is not None and self.delayed_call.active():
+            self._cancelTimer()
+            self._schedule()
+
+    def depth(self, lane = None):
+        if lane is None:
+            return self.pending
+        return len(self.lanes[lane])
+
+    def stats(self):
+        result = []
+        for lane, stats in zip(self.lanes, self.lane_stats):
+            result.append({'depth': len(lane),
+                           'count': stats.count,
+                           'mean_wait': stats.mean_wait,
+                           'max_wait': stats.max_wait,
+                           'wait': stats.wait.snapshot()})
+        return result
+
+    def _refill(self):
+        now = self.reactor.seconds()
+        if not self.paused and now > self.last:
+            self.tokens = min(self.bucket_size, self.tokens + (now - self.last) * self.token_rate)
+        self.last = now
+
+    def _cancelTimer(self):
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+
+    def _hasWaiting(self):
+        # drop cancelled gets from the front of the queue
+        waiting = self.waiting
+        while waiting and waiting[0].called:
+            waiting.popleft()
+        return bool(waiting)
+
+    def _selectLane(self):
+        if self.weights is None:
+            for index, lane in enumerate(self.lanes):
+                if lane:
+                    return index
+
+        best = None
+        total = 0
+        for index, lane in enumerate(self.lanes):
+            if not lane:
+                continue
+            self.credits[index] += self.weights[index]
+            total += self.weights[index]
+            if best is None or self.credits[index] > self.credits[best]:
+                best = index
+        self.credits[best] -= total
+        return best
+
+    def _pop(self):
+        index = self._selectLane()
+        queued, obj = self.lanes[index].popleft()
+        self.pending -= 1
+        self.lane_stats[index].add(self.reactor.seconds() - queued)
+        return obj
+
+    def _schedule(self):
+        if self.paused or not self.pending or not self._hasWaiting():
+            return
+
+        if self.delayed_call is not None and self.delayed_call.active():
             return
 
-        self.reactor.callLater(self.token_rate, self._add)
+        delay = max(self.minimum_delay, (self.token_cost - self.tokens) / self.token_rate)
+        self.delayed_call = self.reactor.callLater(delay, self._run)
 
-        self.tokens += 1.0
-        if self.tokens > self.bucket_size:
-            self.tokens = self.bucket_size
+    def _run(self):
+        self.delayed_call = None
+        if self.paused:
+            return
 
-        while self.tokens >= self.token_cost and self.waiting and self.pending:
+        self._refill()
+
+        while self.tokens >= self.token_cost and self.pending and self._hasWaiting():
             self.tokens -= self.token_cost
-            self.waiting.pop(0).callback(self.pending.pop(0))
+            self.waiting.popleft().callback(self._pop())
+
+        self._schedule()
 
     def _cancel(self, d):
-        self.waiting.remove(d)
+        # the deferred is errbacked with CancelledError which marks it
+        # as called, _hasWaiting() will throw it away later
+        pass
 
     def get(self):
-        if not self.paused and self.tokens >= self.token_cost and self.pending:
-            self.tokens -= self.token_cost
-            return defer.succeed(self.pending.pop(0))
+        if not self.paused and self.pending:
+            self._refill()
+            if self.tokens >= self.token_cost:
+                self.tokens -= self.token_cost
+                return defer.succeed(self._pop())
 
         d = defer.Deferred(canceller = self._cancel)
         self.waiting.append(d)
+        self._schedule()
         return d
 
-    def put(self, obj):
-        if not self.paused and self.tokens >= self.token_cost and self.waiting:
-            self.tokens -= self.token_cost
-            self.waiting.pop(0).callback(obj)
-            return
-
-        self.pending.append(obj)
-
+    def put(self, obj, priority = NORMAL):
+        if not self.paused and not self.pending and self._hasWaiting():
+            self._refill()
+            if self.tokens >= self.token_cost:
+                self.tokens -= self.token_cost
+                self.lane_stats[priority].add(0.0)
+                self.waiting.popleft().callback(obj)
+                return
+
+        self.lanes[priority].append((self.reactor.seconds(), obj))
+        self.pending += 1
+        self._schedule()
@@ -27,10 +27,13 @@ from txHA.insteon import InsteonDevice
 from txHA.insteon import InsteonAddress
 from txHA.insteon import InsteonNetworkPLM
 
+def status(status):
+    log.debug('light level: {}%'.format(status.percent))
+
 def plm_ready(plm):
     log.debug(`plm`)
-    plm.sendOff(InsteonAddress('22.b7.00'))
-    plm.sendStatusRequest(InsteonAddress('22.b7.00'))
+    plm.sendOff(InsteonAddress('22.b7.00')).addErrback(log.err)
+    plm.sendStatusRequest(InsteonAddress('22.b7.00')).addCallbacks(status, log.err)
 
 plm = InsteonNetworkPLM(reactor, '192.168.0.25')
 plm.ready.addCallback(plm_ready)